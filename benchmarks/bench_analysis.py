@@ -0,0 +1,195 @@
+"""
+Benchmarks the analysis hot paths on synthetic walker sets of several sizes, see synthetic.py.
+
+Every stage is run --repeats times and timed. One extra run traces the peak memory allocated by the stage.
+The results are written as JSON so that runs of different versions can be compared:
+    python benchmarks/bench_analysis.py --sizes small medium --output bench.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+import mdtraj as md
+import numpy as np
+
+import synthetic
+from statesampling import colvars
+from statesampling.colvars import cvs as cvs_module
+from statesampling.colvars.io import load_cvs
+from statesampling.iteration_runner import IterationRunner
+from statesampling.utils import topology
+from statesampling.utils.trajs import load_traj_for_regex
+
+
+def measure(fn, repeats, setup=None):
+    """
+    :return: the run times of fn in seconds and the peak memory traced during one extra run
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def _result(size, stage, times, peak, n_frames=None, n_walkers=None):
+    seconds = statistics.median(times)
+    res = {
+        "size": size.name,
+        "stage": stage,
+        "repeats": len(times),
+        "seconds_median": seconds,
+        "seconds_min": min(times),
+        "peak_traced_bytes": peak,
+    }
+    if n_frames is not None:
+        res["frames"] = n_frames
+        res["frames_per_second"] = n_frames / seconds if seconds > 0 else None
+    if n_walkers is not None:
+        res["walkers"] = n_walkers
+        res["walkers_per_second"] = n_walkers / seconds if seconds > 0 else None
+    return res
+
+
+def bench_size(size, data_dir, repeats, n_workers=1):
+    iteration_dir = os.path.join(data_dir, "0")
+    if not os.path.exists(os.path.join(iteration_dir, "s{}.done".format(size.n_walkers - 1))):
+        synthetic.generate(data_dir, size)
+    cvs = list(load_cvs(os.path.join(data_dir, "cvs.json")))
+    contact_cvs = [cv for cv in cvs if isinstance(cv, colvars.ContactCv)]
+    rmsd_cv = [cv for cv in cvs if isinstance(cv, colvars.RmsdCv)][0]
+    results = []
+    cwd = os.getcwd()
+    os.chdir(iteration_dir)
+    try:
+        def load():
+            return load_traj_for_regex("./", "s0.xtc", "s0.gro", query="protein", print_files=False, cvs=cvs)
+
+        times, peak = measure(load, repeats)
+        results.append(_result(size, "load_traj_for_regex", times, peak, n_frames=size.n_frames, n_walkers=1))
+
+        traj = load()
+        times, peak = measure(lambda: colvars.eval_cvs(cvs, traj), repeats)
+        results.append(_result(size, "eval_cvs", times, peak, n_frames=size.n_frames))
+
+        times, peak = measure(lambda: contact_cvs[0].compute_contact(traj), repeats)
+        results.append(_result(size, "ContactCv.compute_contact", times, peak, n_frames=size.n_frames))
+
+        def clear_atom_matching():
+            cvs_module._atoms_incommon_cache.clear()
+
+        times, peak = measure(lambda: rmsd_cv.select_atoms_incommon(traj.topology), repeats,
+                              setup=clear_atom_matching)
+        results.append(_result(size, "RmsdCv.select_atoms_incommon (cold)", times, peak))
+        times, peak = measure(lambda: rmsd_cv.select_atoms_incommon(traj.topology), repeats)
+        results.append(_result(size, "RmsdCv.select_atoms_incommon (warm)", times, peak))
+
+        def create_runner():
+            return IterationRunner(iteration=0,
+                                   swarm_size=size.n_walkers,
+                                   exploration_type="single_state",
+                                   cvs=cvs,
+                                   n_workers=n_workers,
+                                   use_cache=False,
+                                   incremental_analysis=False,
+                                   use_checkpoint=False)
+
+        distances = np.random.RandomState(0).gamma(2., 1., size=size.n_walkers)
+        runner = create_runner()
+        times, peak = measure(lambda: runner._compute_number_of_replicas(distances), repeats)
+        results.append(_result(size, "_compute_number_of_replicas", times, peak, n_walkers=size.n_walkers))
+
+        n_frames = size.n_frames * size.n_walkers
+        times, peak = measure(lambda: create_runner().compute_center_distances(), repeats,
+                              setup=topology.clear_cache)
+        results.append(_result(size, "compute_center_distances", times, peak,
+                               n_frames=n_frames, n_walkers=size.n_walkers))
+
+        def clear_next_iteration():
+            topology.clear_cache()
+            shutil.rmtree("../1", ignore_errors=True)
+
+        times, peak = measure(lambda: create_runner().postprocess(), repeats, setup=clear_next_iteration)
+        results.append(_result(size, "postprocess", times, peak, n_frames=n_frames, n_walkers=size.n_walkers))
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def create_argparser():
+    p = argparse.ArgumentParser(epilog='Benchmarks of the analysis hot paths on synthetic trajectories')
+    p.add_argument('--sizes', type=str, nargs='+', help='Sizes to benchmark', choices=sorted(synthetic.SIZES),
+                   default=["small", "medium"])
+    p.add_argument('--repeats', type=int, help='Timed runs of every stage', default=3)
+    p.add_argument('--n_workers', type=int, help='Processes used to evaluate the walkers in the runner stages',
+                   default=1)
+    p.add_argument('--data_dir', type=str,
+                   help='Directory for the synthetic data. It is reused between runs if set, otherwise a temporary '
+                        'directory is used and removed afterwards',
+                   default=None)
+    p.add_argument('--output', type=str, help='JSON file for the results. Printed to stdout if not set', default=None)
+    return p
+
+
+def main(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="statesampling-bench-")
+    results = []
+    try:
+        for name in args.sizes:
+            size = synthetic.SIZES[name]
+            print("Benchmarking {} system: {}".format(name, size.to_dict()), file=sys.stderr)
+            results += bench_size(size, os.path.abspath(os.path.join(data_dir, name)), args.repeats,
+                                  n_workers=args.n_workers)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    report = {
+        "created": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "mdtraj": md.__version__,
+        "sizes": [synthetic.SIZES[name].to_dict() for name in args.sizes],
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "results": results,
+    }
+    for r in results:
+        print("{:8s} {:40s} {:10.4f} s {}".format(r["size"], r["stage"], r["seconds_median"],
+                                                  "{:.0f} frames/s".format(r["frames_per_second"])
+                                                  if r.get("frames_per_second") else ""),
+              file=sys.stderr)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == '__main__':
+    main(create_argparser().parse_args())
@@ -0,0 +1,59 @@
+"""
+Checks that importing the package and parsing the command line arguments of main.py stays fast.
+Heavy dependencies (mdtraj, matplotlib and scipy) must only be imported on first use.
+
+Run from the repository root:
+    python benchmarks/check_startup.py --budget 1.0
+The script exits with a non-zero status if the check fails.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import statesampling
+import main
+main.create_argparser().parse_args(['--iteration', '0', '--working_dir', 'simu'])
+import evaluate_walker
+evaluate_walker.create_argparser().parse_args(['--walker', '0', '--cvs', 'cvs.json'])
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "modules": [m for m in %s if m in sys.modules]}))
+"""
+
+HEAVY_MODULES = ["mdtraj", "matplotlib", "scipy"]
+
+
+def measure_startup() -> dict:
+    """Imports the package and parses the arguments in a fresh interpreter"""
+    script = "import json\n" + _STARTUP_SCRIPT % repr(HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", script], cwd=_ROOT, universal_newlines=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def create_argparser():
+    p = argparse.ArgumentParser(epilog='Startup time regression check')
+    p.add_argument('--budget', type=float, help='Maximum startup time in seconds', default=1.0)
+    p.add_argument('--repeats', type=int, help='The fastest of this many runs is compared to the budget', default=5)
+    return p
+
+
+if __name__ == '__main__':
+    args = create_argparser().parse_args()
+    results = [measure_startup() for _ in range(args.repeats)]
+    seconds = min(r["seconds"] for r in results)
+    heavy_modules = results[0]["modules"]
+    print("Startup took {:.3f} s (budget {:.3f} s)".format(seconds, args.budget))
+    failed = False
+    if len(heavy_modules) > 0:
+        print("FAIL: {} imported at startup".format(", ".join(heavy_modules)))
+        failed = True
+    if seconds > args.budget:
+        print("FAIL: startup exceeded the budget")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,89 @@
+"""
+Synthetic protein-like systems for the benchmarks, generated with mdtraj so that no simulation data is needed.
+"""
+import json
+import os
+from dataclasses import dataclass
+
+import mdtraj as md
+import numpy as np
+
+_BACKBONE = [("N", "N"), ("CA", "C"), ("C", "C"), ("O", "O"), ("CB", "C"), ("H", "H")]
+
+
+@dataclass
+class SystemSize(object):
+    """The dimensions of a synthetic walker set"""
+    name: str
+    n_residues: int  # protein residues. At least 268 so that the default pbc_query of load_traj_for_regex matches
+    n_waters: int
+    n_frames: int  # per walker
+    n_walkers: int
+    n_cvs: int  # contact CVs. One RMSD CV is added on top of them
+
+    @property
+    def n_atoms(self) -> int:
+        return self.n_residues * len(_BACKBONE) + self.n_waters
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__, n_atoms=self.n_atoms)
+
+
+SIZES = {
+    "small": SystemSize("small", n_residues=300, n_waters=200, n_frames=50, n_walkers=4, n_cvs=8),
+    "medium": SystemSize("medium", n_residues=600, n_waters=2000, n_frames=200, n_walkers=16, n_cvs=32),
+    "large": SystemSize("large", n_residues=1200, n_waters=10000, n_frames=1000, n_walkers=24, n_cvs=64),
+}
+
+
+def create_topology(size: SystemSize) -> md.Topology:
+    top = md.Topology()
+    chain = top.add_chain()
+    for r in range(size.n_residues):
+        residue = top.add_residue("ALA", chain, resSeq=r + 1)
+        for name, element in _BACKBONE:
+            top.add_atom(name, md.element.get_by_symbol(element), residue)
+    chain = top.add_chain()
+    for w in range(size.n_waters):
+        residue = top.add_residue("HOH", chain, resSeq=w + 1)
+        top.add_atom("O", md.element.oxygen, residue)
+    return top
+
+
+def generate(directory: str, size: SystemSize, seed: int = 0) -> str:
+    """
+    Writes an iteration directory with the trajectory s{i}.xtc, final frame s{i}.gro and s{i}.done of every walker,
+    a starting structure equilibrated.gro used as RMSD reference and cvs.json.
+    The protein stays in the middle of the box so that it is never broken by the periodic boundary conditions.
+    :return: the iteration directory
+    """
+    iteration_dir = os.path.join(directory, "0")
+    os.makedirs(iteration_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    top = create_topology(size)
+    box = 10.
+    start = rng.uniform(0.35 * box, 0.65 * box, size=(top.n_atoms, 3)).astype(np.float32)
+    unitcell = dict(unitcell_lengths=np.full((1, 3), box), unitcell_angles=np.full((1, 3), 90.))
+    md.Trajectory(start[None], top, **unitcell).save_gro(os.path.join(directory, "equilibrated.gro"))
+    for i in range(size.n_walkers):
+        # A random walk away from the starting structure, a little different for every walker
+        steps = rng.normal(0, 0.002 * (1 + i % 4), size=(size.n_frames, top.n_atoms, 3)).astype(np.float32)
+        xyz = start[None] + np.cumsum(steps, axis=0)
+        traj = md.Trajectory(xyz, top,
+                             time=np.arange(size.n_frames, dtype=float),
+                             unitcell_lengths=np.full((size.n_frames, 3), box),
+                             unitcell_angles=np.full((size.n_frames, 3), 90.))
+        traj.save_xtc(os.path.join(iteration_dir, "s{}.xtc".format(i)))
+        traj[-1].save_gro(os.path.join(iteration_dir, "s{}.gro".format(i)))
+        with open(os.path.join(iteration_dir, "s{}.done".format(i)), "w"):
+            pass
+    cvs = []
+    for k in range(size.n_cvs):
+        res1, res2 = rng.choice(np.arange(1, size.n_residues + 1), size=2, replace=False)
+        cvs.append({"@class": "InverseContactCv" if k % 2 else "ContactCv", "id": "contact{}".format(k),
+                    "res1": int(res1), "res2": int(res2), "scale": 1.0, "offset": 0.0})
+    cvs.append({"@class": "RmsdCv", "id": "rmsd", "reference_file": "equilibrated.gro",
+                "query": "protein and name CA", "scale": 1.0, "offset": 0.0})
+    with open(os.path.join(directory, "cvs.json"), "w") as out:
+        json.dump({"cvs": cvs}, out, indent=2)
+    return iteration_dir
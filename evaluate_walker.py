@@ -0,0 +1,44 @@
+import argparse
+
+from statesampling import log, colvars
+from statesampling.colvars.io import load_cvs
+from statesampling.walkers import evaluate_walker, walker_cache_key
+
+_log = log.getLogger("evaluate_walker")
+
+
+def start(args):
+    cvs = load_cvs(args.cvs)
+    directory = args.working_dir.rstrip("/") + "/"
+    cvs_hash = colvars.io.cvs_fingerprint(cvs)
+    if cvs_hash is None:
+        raise ValueError("The CVs in {} cannot be serialized and thus not be precomputed".format(args.cvs))
+    evals = evaluate_walker(args.walker, cvs, query=args.query, directory=directory, cvs_hash=cvs_hash,
+                            chunk_size=args.chunk_size, use_cache=False)
+    key = walker_cache_key(args.walker, cvs_hash, query=args.query, directory=directory)
+    colvars.cache.save_precomputed_evals("{}s{}.xtc".format(directory, args.walker), key, evals)
+    _log.info("Evaluated %s CVs on %s frames of walker %s", evals.shape[1], evals.shape[0], args.walker)
+    if args.touch_done:
+        with open("{}s{}.done".format(directory, args.walker), "a"):
+            pass
+
+
+def create_argparser():
+    p = argparse.ArgumentParser(
+        epilog='Evaluates the CVs of a finished walker so that the state sampling server does not have to.\n'
+               'Call it from the walker job script before the walker is marked as done.')
+    p.add_argument('--walker', type=int, help='Walker index, usually $SLURM_ARRAY_TASK_ID', required=True)
+    p.add_argument('--cvs', type=str, help='Path to CVs file', required=True)
+    p.add_argument('--working_dir', type=str, help='Iteration directory with the walker files', default="./")
+    p.add_argument('--query', type=str, help='Atom selection, same as the server', default="protein")
+    p.add_argument('--chunk_size', type=int,
+                   help='Stream the trajectory in chunks of this many frames instead of loading it into memory',
+                   required=False,
+                   default=None)
+    p.add_argument('--touch_done', action='store_true', help='Create s{walker}.done after the CVs have been saved')
+    return p
+
+
+if __name__ == '__main__':
+    p = create_argparser()
+    start(p.parse_args())
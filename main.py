@@ -1,10 +1,18 @@
 import argparse
+import functools
+import json
 import os
 
+import numpy as np
+
 from statesampling import log
 from statesampling.colvars import eval_cvs
+from statesampling.async_runner import AsyncSwarmRunner
 from statesampling.colvars.io import load_cvs
+from statesampling.coordinator import Coordinator, SamplingRun
+from statesampling.executors import create_executor, create_process_pool
 from statesampling.iteration_runner import IterationRunner
+from statesampling.store import CvStore
 from statesampling.utils.io import makedirs
 from statesampling.utils.trajs import load_traj_for_regex
 from statesampling.utils.visualization import show_convergence
@@ -15,19 +23,22 @@ _log = log.getLogger("main")
 def start(args):
     _log.info("Using args %s", args)
     start_mode = args.start_mode
+    if start_mode == "coordinator":
+        start_coordinator(args)
+        return
+    if args.working_dir is None:
+        raise ValueError("--working_dir is required in start mode {}".format(start_mode))
     iteration = args.iteration
-    cvs = load_cvs(args.cvs)
-    cwd = os.getcwd() + "/" + args.working_dir + "/"
-    starting_structure = load_traj_for_regex(directory=cwd,
-                                             traj_filename=None,
-                                             top_filename=args.starting_structure)
-    center_points = [eval_cvs(cvs, starting_structure).squeeze()]
+    cvs, cwd, center_points, store = _prepare_run(args)
+    # The starting structure is known exactly
+    center_variances = [np.zeros_like(center_points[0])]
+    executor = create_executor(args.executor, max_workers=args.local_workers)
+    if start_mode == "async":
+        start_async(args, cvs, executor, cwd, center_points)
+        return
     while iteration <= args.max_iteration:
         wd = cwd + str(iteration)
-        runner = IterationRunner(iteration=iteration,
-                                 swarm_size=args.swarm_size,
-                                 cvs=cvs,
-                                 exploration_type=args.exploration_type)
+        runner = _create_runner(args, iteration, cvs=cvs, executor=executor, store=store)
         if start_mode == "server":
             if runner.simulations_finished():
                 _log.info("Simulation already finished from before.")
@@ -51,13 +62,123 @@ def start(args):
         _log.info("Computing convergence")
         center, _ = runner.compute_center_distances()
         center_points.append(center)
+        center_variances.append(runner.center_variance())
         _log.info("Finished with iteration %s.", iteration)
         iteration += 1
 
-    show_convergence(center_points, outfile="{}/convergence_{}.png".format(cwd, args.simu_id))
+    executor.shutdown()
+    show_convergence(center_points, outfile="{}/convergence_{}.png".format(cwd, args.simu_id),
+                     center_variances=center_variances)
     _log.info("Max iteration reached. Finished")
 
 
+def _prepare_run(args):
+    """
+    :return: the CVs, the absolute working directory, the center points starting with the starting structure and the
+    CV store of a run
+    """
+    cvs = load_cvs(args.cvs)
+    cwd = os.getcwd() + "/" + args.working_dir + "/"
+    starting_structure = load_traj_for_regex(directory=cwd,
+                                             traj_filename=None,
+                                             top_filename=args.starting_structure)
+    center_points = [eval_cvs(cvs, starting_structure).squeeze()]
+    store = None
+    if not args.no_store:
+        store = CvStore.for_cvs(cwd + "cvstore", cvs)
+        store.append_iteration(-1, center=center_points[0], center_variance=np.zeros_like(center_points[0]))
+    return cvs, cwd, center_points, store
+
+
+def _create_runner(args, iteration, cvs, executor, store, analysis_pool=None):
+    return IterationRunner(iteration=iteration,
+                           swarm_size=args.swarm_size,
+                           cvs=cvs,
+                           exploration_type=args.exploration_type,
+                           n_workers=args.n_workers,
+                           use_cache=not args.no_cache,
+                           chunk_size=args.chunk_size,
+                           # The coordinator never blocks on the evaluation of a run's walkers
+                           incremental_analysis=analysis_pool is not None or not args.no_incremental_analysis,
+                           quorum=args.quorum,
+                           straggler_timeout_factor=args.straggler_timeout_factor,
+                           max_resubmissions=args.max_resubmissions,
+                           executor=executor,
+                           store=store,
+                           use_checkpoint=not args.no_checkpoint,
+                           seed_mode=args.seed_mode,
+                           replica_allocation=args.replica_allocation,
+                           seed=args.seed,
+                           collect_metrics=args.metrics,
+                           profile=args.profile,
+                           analysis_pool=analysis_pool,
+                           center_weighting=args.center_weighting)
+
+
+def start_coordinator(args):
+    """
+    Drives all runs of the --runs file from this process.
+    Every run takes its arguments from the command line, overridden by its entry in the file.
+    The CVs of all runs are evaluated by one pool of --analysis_workers processes.
+    """
+    with open(args.runs) as f:
+        run_definitions = json.load(f)["runs"]
+    analysis_pool = create_process_pool(args.analysis_workers)
+    runs, executors = [], []
+    for definition in run_definitions:
+        run_args = argparse.Namespace(**dict(vars(args), **definition))
+        if run_args.working_dir is None:
+            raise ValueError("No working_dir for run {}".format(definition))
+        cvs, cwd, center_points, store = _prepare_run(run_args)
+        executor = create_executor(run_args.executor, max_workers=run_args.local_workers)
+        executors.append(executor)
+        run = SamplingRun(name=definition.get("name", run_args.working_dir),
+                          working_dir=cwd,
+                          iteration=run_args.iteration,
+                          max_iteration=run_args.max_iteration,
+                          create_runner=functools.partial(_create_runner, run_args, cvs=cvs, executor=executor,
+                                                          store=store, analysis_pool=analysis_pool),
+                          center_points=center_points,
+                          center_variances=[np.zeros_like(center_points[0])])
+        runs.append((run, run_args))
+    try:
+        Coordinator(runs=[run for run, _ in runs], seconds_to_sleep=args.seconds_between_ticks).run()
+    finally:
+        for executor in executors:
+            executor.shutdown()
+        analysis_pool.shutdown()
+    for run, run_args in runs:
+        if not run.failed:
+            show_convergence(run.center_points,
+                             outfile="{}/convergence_{}.png".format(run.working_dir, run_args.simu_id),
+                             center_variances=run.center_variances)
+    _log.info("All runs finished")
+
+
+def start_async(args, cvs, executor, cwd, center_points):
+    wd = cwd + "async"
+    makedirs(wd, overwrite=False)
+    _log.info("Changing directory to %s", wd)
+    os.chdir(wd)
+    runner = AsyncSwarmRunner(swarm_size=args.swarm_size,
+                              cvs=cvs,
+                              exploration_type=args.exploration_type,
+                              max_walkers=args.swarm_size * (args.max_iteration - args.iteration + 1),
+                              initial_structure=cwd + args.starting_structure,
+                              query="protein",
+                              use_cache=not args.no_cache,
+                              chunk_size=args.chunk_size,
+                              max_resubmissions=args.max_resubmissions,
+                              seed=args.seed,
+                              executor=executor)
+    center_points += runner.run()
+    executor.shutdown()
+    show_convergence(center_points,
+                     outfile="{}/convergence_{}.png".format(cwd, args.simu_id),
+                     xlabel="Window of {} endpoints".format(runner.window_size))
+    _log.info("Max number of walkers reached. Finished")
+
+
 def create_argparser():
     p = argparse.ArgumentParser(
         epilog='State sampling code. Intended to dispatch bash jobs and analyze the resulting trajectories iteratively.\nBy Oliver Fleetwood 2019.')
@@ -65,16 +186,80 @@ def create_argparser():
     p.add_argument('--simu_id', type=str, help='ID to identify this simu', required=False, default="ss")
     p.add_argument('--starting_structure', type=str, required=False, default="equilibrated.gro")
     p.add_argument('--cvs', type=str, help='Path to CVs file', required=False, default="cvs.json")
-    p.add_argument('--start_mode', type=str, help="Start mode ('server' or 'convergence')", default="server")
+    p.add_argument('--start_mode', type=str, help="Start mode ('server', 'convergence', 'async' or 'coordinator')", default="server")
     p.add_argument('--exploration_type', type=str, help="Type of exploration ('single_state' or 'multi_state')",
                    default="single_state")
-    p.add_argument('--working_dir', type=str, help='working directory', required=True)
+    p.add_argument('--working_dir', type=str, help='working directory. Required unless in coordinator mode',
+                   required=False, default=None)
     p.add_argument('--max_iteration', type=int, help='Maximum iteration number or the job will finish',
                    required=False,
                    default=15)  # Fairly low so that you make sure to check that everything is working as expected
     p.add_argument('--swarm_size', type=int,
                    help='Number of trajectories every iteration',
                    default=24)
+    p.add_argument('--n_workers', type=int,
+                   help='Number of processes used to evaluate the CVs of the walkers after every iteration',
+                   default=1)
+    p.add_argument('--no_cache', action='store_true',
+                   help='Always reevaluate the CVs instead of reusing the values cached next to the trajectories')
+    p.add_argument('--chunk_size', type=int,
+                   help='Stream walker trajectories in chunks of this many frames instead of loading them into memory',
+                   required=False,
+                   default=None)
+    p.add_argument('--no_incremental_analysis', action='store_true',
+                   help='Wait for all walkers to finish before evaluating any CVs')
+    p.add_argument('--quorum', type=int,
+                   help='Start the next iteration once this many walkers have finished. The rest are excluded',
+                   required=False,
+                   default=None)
+    p.add_argument('--straggler_timeout_factor', type=float,
+                   help='Start the next iteration, excluding unfinished walkers, when the waiting time exceeds this many median walker completion times',
+                   required=False,
+                   default=None)
+    p.add_argument('--max_resubmissions', type=int,
+                   help='Number of times a walker that left the queue without finishing is resubmitted before it is excluded',
+                   default=1)
+    p.add_argument('--executor', type=str,
+                   help="Backend running the walkers ('slurm' or 'local')",
+                   default="slurm")
+    p.add_argument('--local_workers', type=int,
+                   help="Number of walkers run concurrently by the 'local' executor. Defaults to the number of CPUs",
+                   required=False,
+                   default=None)
+    p.add_argument('--no_store', action='store_true',
+                   help='Do not record CV values and iteration results in the cvstore directory of the working directory')
+    p.add_argument('--no_checkpoint', action='store_true',
+                   help='Do not resume iterations from the checkpoint.json saved in their directory')
+    p.add_argument('--seed_mode', type=str,
+                   help="How the replicas of a walker are created in the next iteration ('copy', 'hardlink' or 'symlink'). "
+                        "Links write every structure only once and fall back to copies if they are not supported",
+                   default="copy")
+    p.add_argument('--replica_allocation', type=str,
+                   help="How replicas are distributed over the walkers ('largest_remainder', 'residual' or 'systematic')",
+                   default="largest_remainder")
+    p.add_argument('--seed', type=int, help='Random seed, for reproducible replica allocation', required=False,
+                   default=None)
+    p.add_argument('--center_weighting', type=str,
+                   help="How the frames of the walkers are weighted in the center ('frame': every frame counts equally, "
+                        "'walker': every walker counts equally, however many frames it has)",
+                   default="frame")
+    p.add_argument('--metrics', action='store_true',
+                   help='Write stage durations and walker metrics to metrics.json and walker_metrics.csv in every '
+                        'iteration directory')
+    p.add_argument('--profile', action='store_true',
+                   help='Write a cProfile dump of every iteration to profile.prof in its directory')
+    p.add_argument('--runs', type=str,
+                   help="JSON file with the runs of the 'coordinator' start mode, e.g. "
+                        "{\"runs\": [{\"working_dir\": \"ligand1\", \"exploration_type\": \"multi_state\"}]}. "
+                        "Every entry overrides the command line arguments for its run",
+                   required=False,
+                   default="runs.json")
+    p.add_argument('--analysis_workers', type=int,
+                   help="Number of processes evaluating the CVs of all runs in the 'coordinator' start mode",
+                   default=4)
+    p.add_argument('--seconds_between_ticks', type=float,
+                   help="Seconds the coordinator sleeps after checking all runs once",
+                   default=3)
     return p
 
 
@@ -0,0 +1,192 @@
+import glob
+import os
+import re
+import shutil
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Set, Deque, Tuple
+
+import numpy as np
+
+from . import log, colvars
+from .executors import WalkerExecutor, SlurmExecutor
+from .iteration_runner import compute_weights
+from .summaries import WalkerSummary, estimate_center, distances_to_center
+from .walkers import evaluate_walker
+
+_log = log.getLogger(__name__)
+
+
+@dataclass
+class AsyncSwarmRunner(object):
+    """
+    Barrier free version of the swarm. All walkers run in the same directory and are numbered consecutively.
+    As soon as a walker finishes, a new walker is seeded from the endpoints of the most recently finished walkers,
+    weighted the same way as replicas are in IterationRunner, so that swarm_size walkers are always running.
+    """
+    swarm_size: int
+    exploration_type: str
+    cvs: List[colvars.CV]
+    max_walkers: int  # total number of walkers to run before stopping
+    window_size: Optional[int] = None  # number of recent endpoints to compute the center from. Defaults to swarm_size
+    initial_structure: Optional[str] = None  # seeds the first walkers if their in-{i}.gro files do not exist
+    seconds_to_sleep: Optional[int] = 3
+    seconds_between_queue_checks: Optional[int] = 60
+    max_resubmissions: Optional[int] = 1
+    query: Optional[str] = "protein"
+    use_cache: Optional[bool] = True
+    chunk_size: Optional[int] = None
+    seed: Optional[int] = None
+    executor: Optional[WalkerExecutor] = None
+    center_points: List[np.array] = field(default_factory=list, init=False, repr=False)
+    _running: Set[int] = field(default_factory=set, init=False, repr=False)
+    _window: Deque[Tuple[int, WalkerSummary]] = field(default=None, init=False, repr=False)
+    _resubmissions: Dict[int, int] = field(default_factory=dict, init=False, repr=False)
+    _n_started: int = field(default=0, init=False, repr=False)
+    _n_finished: int = field(default=0, init=False, repr=False)
+    _rng: np.random.RandomState = field(default=None, init=False, repr=False)
+    _cvs_hash: Optional[str] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.window_size is None:
+            self.window_size = self.swarm_size
+        if self.executor is None:
+            self.executor = SlurmExecutor()
+        self._window = deque(maxlen=self.window_size)
+        self._rng = np.random.RandomState(self.seed)
+        self._cvs_hash = colvars.io.cvs_fingerprint(self.cvs)
+
+    def run(self) -> List[np.array]:
+        """
+        Runs walkers in the current directory until max_walkers have finished
+        :return: the center of the window of recent endpoints, recorded every window_size finished walkers
+        """
+        self._restore()
+        self._fill_swarm()
+        last_queue_check = time.time()
+        while self._n_finished < self.max_walkers and len(self._running) > 0:
+            self.executor.wait(self.seconds_to_sleep)
+            for i in sorted(self._running):
+                if self.executor.finished(i):
+                    self._on_walker_finished(i)
+            if time.time() - last_queue_check >= self.seconds_between_queue_checks:
+                self._handle_lost_walkers()
+                last_queue_check = time.time()
+            self._fill_swarm()
+        _log.info("%s walkers finished", self._n_finished)
+        return self.center_points
+
+    def center(self) -> np.array:
+        """The mean of all frames of the walkers in the window"""
+        return estimate_center([summary for _, summary in self._window]).center
+
+    def _on_walker_finished(self, walker_idx: int) -> None:
+        self._running.discard(walker_idx)
+        self._add_to_window(walker_idx)
+        self._n_finished += 1
+        _log.info("Walker %s finished (%s/%s)", walker_idx, self._n_finished, self.max_walkers)
+        if self._n_finished % self.window_size == 0:
+            self.center_points.append(self.center())
+
+    def _add_to_window(self, walker_idx: int) -> None:
+        evals = evaluate_walker(walker_idx, self.cvs, query=self.query, directory="./", cvs_hash=self._cvs_hash,
+                                chunk_size=self.chunk_size, use_cache=self.use_cache)
+        self._window.append((walker_idx, WalkerSummary.from_evals(evals, with_squares=False)))
+
+    def _fill_swarm(self) -> None:
+        """Seeds and submits new walkers until swarm_size walkers are running or max_walkers have been started"""
+        new_walkers = []
+        while len(self._running) + len(new_walkers) < self.swarm_size \
+                and self._n_started + len(new_walkers) < self.max_walkers:
+            walker_idx = self._n_started + len(new_walkers)
+            self._seed_walker(walker_idx)
+            new_walkers.append(walker_idx)
+        if len(new_walkers) > 0:
+            for i in new_walkers:
+                with open("s{}.submitted".format(i), "w"):
+                    pass
+            self._running.update(new_walkers)
+            self._n_started += len(new_walkers)
+            self.executor.submit(new_walkers)
+            self._record_jobs(new_walkers)
+
+    def _record_jobs(self, walker_indices: List[int]) -> None:
+        """Writes the job id of every walker to its s{i}.submitted file, so that it can be tracked after a restart"""
+        jobs = self.executor.jobs()
+        for i in walker_indices:
+            with open("s{}.submitted".format(i), "w") as out:
+                out.write(jobs.get(i, ""))
+
+    def _seed_walker(self, walker_idx: int) -> None:
+        infile = "in-{}.gro".format(walker_idx)
+        if os.path.exists(infile):
+            # Prepared by the user or seeded before a restart
+            return
+        if len(self._window) > 0:
+            source_idx = self._choose_source_walker()
+            _log.info("Walker %s will be seeded from walker %s", walker_idx, source_idx)
+            shutil.copy("s{}.gro".format(source_idx), infile)
+        elif self.initial_structure is not None:
+            shutil.copy(self.initial_structure, infile)
+        else:
+            raise FileNotFoundError("No input structure {} and no initial structure set".format(infile))
+
+    def _choose_source_walker(self) -> int:
+        walkers = [w for w, _ in self._window]
+        distance_to_center = distances_to_center([summary for _, summary in self._window], self.center())
+        weights = compute_weights(distance_to_center, self.exploration_type)
+        return walkers[self._rng.choice(len(walkers), p=weights / weights.sum())]
+
+    def _handle_lost_walkers(self) -> None:
+        stopped = self.executor.stopped_walkers(sorted(self._running))
+        lost = [i for i in stopped if not self.executor.finished(i)]
+        for i in lost:
+            if self._resubmissions.get(i, 0) < self.max_resubmissions:
+                _log.warning("Walker %s stopped without finishing. Resubmitting it", i)
+                self._resubmissions[i] = self._resubmissions.get(i, 0) + 1
+                self.executor.submit([i])
+                self._record_jobs([i])
+            else:
+                _log.warning("Walker %s stopped without finishing too many times. It will be replaced", i)
+                with open("s{}.excluded".format(i), "w"):
+                    pass
+                self.executor.cancel([i])
+                self._running.discard(i)
+
+    def _restore(self) -> None:
+        """Picks up the walkers submitted by a previous run in this directory"""
+        submitted = sorted(int(re.match(r"s(\d+)\.submitted", os.path.basename(f)).group(1))
+                           for f in glob.glob("s*.submitted"))
+        if len(submitted) == 0:
+            return
+        finished = [i for i in submitted if os.path.exists("s{}.done".format(i))]
+        excluded = [i for i in submitted if os.path.exists("s{}.excluded".format(i))]
+        finished.sort(key=lambda i: os.path.getmtime("s{}.done".format(i)))
+        for i in finished[-self.window_size:]:
+            self._add_to_window(i)
+        self._n_finished = len(finished)
+        self._n_started = submitted[-1] + 1
+        self._running = set(i for i in submitted if i not in finished and i not in excluded)
+        _log.info("Restored %s started and %s finished walkers", self._n_started, self._n_finished)
+        self._resume_jobs()
+
+    def _resume_jobs(self) -> None:
+        """
+        Keeps tracking the running walkers of a previous run by their job ids.
+        Walkers without a job id, e.g. local processes, cannot be tracked and are submitted again
+        """
+        jobs = {}
+        for i in sorted(self._running):
+            with open("s{}.submitted".format(i)) as f:
+                job_id = f.read().strip()
+            if len(job_id) > 0:
+                jobs[i] = job_id
+        self.executor.restore_jobs(jobs)
+        if len(jobs) > 0:
+            _log.info("Assuming walkers %s from a previous run are still running", sorted(jobs))
+        untracked = [i for i in sorted(self._running) if i not in jobs]
+        if len(untracked) > 0:
+            _log.warning("Walkers %s cannot be tracked after the restart. Submitting them again", untracked)
+            self.executor.submit(untracked)
+            self._record_jobs(untracked)
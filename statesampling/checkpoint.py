@@ -0,0 +1,69 @@
+import json
+import os
+from dataclasses import dataclass, field, asdict
+from typing import Optional, List, Dict
+
+from . import log
+
+_log = log.getLogger(__name__)
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+@dataclass
+class IterationCheckpoint(object):
+    """
+    The progress of an iteration, saved in the iteration directory so that a restarted server resumes where it stopped
+    without resubmitting running walkers, recomputing the CVs or seeding the next iteration again.
+    """
+    iteration: int
+    cvs_hash: Optional[str] = None  # as returned by colvars.io.cvs_fingerprint
+    submitted: List[int] = field(default_factory=list)  # walkers submitted by the server
+    submission_time: Optional[float] = None
+    jobs: Dict[int, str] = field(default_factory=dict)  # job ids of the submitted walkers, see WalkerExecutor.jobs
+    resubmissions: Dict[int, int] = field(default_factory=dict)
+    finished_walkers: Optional[List[int]] = None  # set when the server stopped waiting for the walkers
+    center: Optional[List[float]] = None
+    center_variance: Optional[List[float]] = None  # per CV, see summaries.estimate_center
+    distance_to_center: Optional[List[float]] = None  # in the order of finished_walkers
+    n_replicas: Optional[List[int]] = None  # in the order of finished_walkers
+    seeded: bool = False  # True when the next iteration has been seeded
+
+    def save(self, filename: Optional[str] = CHECKPOINT_FILE) -> None:
+        """Atomically replaces the checkpoint file, so that it is never left half written"""
+        tmp_file = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp_file, "w") as out:
+            json.dump(asdict(self), out, indent=2)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, iteration: int, cvs_hash: Optional[str],
+             filename: Optional[str] = CHECKPOINT_FILE) -> 'IterationCheckpoint':
+        """
+        :return: the saved checkpoint, or an empty one if there is none.
+        The analysis results are discarded if the checkpoint was saved with other CVs.
+        """
+        if not os.path.exists(filename):
+            return cls(iteration=iteration, cvs_hash=cvs_hash)
+        with open(filename) as f:
+            values = json.load(f)
+        # JSON object keys are always strings
+        values["jobs"] = {int(k): v for k, v in values.get("jobs", {}).items()}
+        values["resubmissions"] = {int(k): v for k, v in values.get("resubmissions", {}).items()}
+        checkpoint = cls(**values)
+        if checkpoint.iteration != iteration:
+            raise ValueError("Checkpoint {} belongs to iteration {}, not {}".format(
+                os.path.abspath(filename), checkpoint.iteration, iteration))
+        if checkpoint.cvs_hash != cvs_hash:
+            _log.warning("Checkpoint of iteration %s was saved with other CVs. The center will be recomputed", iteration)
+            checkpoint.cvs_hash = cvs_hash
+            checkpoint.center = None
+            checkpoint.center_variance = None
+            checkpoint.distance_to_center = None
+        return checkpoint
+
+    @property
+    def analyzed(self) -> bool:
+        return self.center is not None and self.distance_to_center is not None
@@ -1,3 +1,3 @@
 from .cvs import CV, ContactCv, InverseContactCv, RmsdCv
 from .eval_utils import *
-from . import io
\ No newline at end of file
+from . import io, cache
\ No newline at end of file
@@ -0,0 +1,95 @@
+import json
+import os
+from typing import Optional, List
+
+import numpy as np
+
+from .. import log
+
+_log = log.getLogger("colvars-cache")
+
+
+def cache_path(traj_file: str) -> str:
+    """The file storing the cached CV values for a trajectory, next to the trajectory itself"""
+    return os.path.splitext(traj_file)[0] + ".cvcache.npz"
+
+
+def create_cache_key(files: List[str], cvs_hash: str, query: Optional[str] = None) -> str:
+    """
+    A key which changes whenever any of the input files, the CV definitions or the atom selection changes
+    :param files: trajectory and topology files the CVs were evaluated on
+    :param cvs_hash: as returned by colvars.io.cvs_fingerprint
+    :param query:
+    :return: the key as a string
+    """
+    file_stats = []
+    for f in files:
+        stat = os.stat(f)
+        file_stats.append([os.path.basename(f), stat.st_size, stat.st_mtime_ns])
+    return json.dumps({"files": file_stats, "cvs": cvs_hash, "query": query}, sort_keys=True)
+
+
+def load_cached_evals(cache_file: str, key: str) -> Optional[np.array]:
+    """
+    :return: the cached CV values, or None if there is no cache or if it was created with a different key
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file, allow_pickle=False) as data:
+            if str(data["key"]) != key:
+                _log.debug("Cache %s is stale", cache_file)
+                return None
+            return data["evals"]
+    except Exception as ex:
+        _log.warning("Could not read cache %s (%s). It will be recomputed", cache_file, ex)
+        return None
+
+
+def save_cached_evals(cache_file: str, key: str, evals: np.array) -> None:
+    """Atomically writes the CV values to the cache so that concurrent readers never see a partial file"""
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(tmp_file, "wb") as out:
+        np.savez(out, key=np.array(key), evals=evals)
+    os.replace(tmp_file, cache_file)
+
+
+def precomputed_path(traj_file: str) -> str:
+    """The file with CV values precomputed by the walker itself, see evaluate_walker.py"""
+    return os.path.splitext(traj_file)[0] + ".cvs.npy"
+
+
+def _precomputed_key_path(traj_file: str) -> str:
+    return os.path.splitext(traj_file)[0] + ".cvs.json"
+
+
+def load_precomputed_evals(traj_file: str, key: str) -> Optional[np.array]:
+    """
+    :return: the CV values precomputed for the trajectory, or None if they are missing or were created with another key
+    """
+    key_file = _precomputed_key_path(traj_file)
+    if not os.path.exists(key_file):
+        return None
+    try:
+        with open(key_file) as f:
+            if f.read() != key:
+                _log.debug("Precomputed CVs for %s are stale", traj_file)
+                return None
+        return np.load(precomputed_path(traj_file), allow_pickle=False)
+    except Exception as ex:
+        _log.warning("Could not read precomputed CVs for %s (%s)", traj_file, ex)
+        return None
+
+
+def save_precomputed_evals(traj_file: str, key: str, evals: np.array) -> None:
+    """Writes the CV values and then their key, so that a key file is only present for complete CV values"""
+    npy_file = precomputed_path(traj_file)
+    tmp_file = "{}.{}.tmp".format(npy_file, os.getpid())
+    with open(tmp_file, "wb") as out:
+        np.save(out, evals)
+    os.replace(tmp_file, npy_file)
+    key_file = _precomputed_key_path(traj_file)
+    tmp_file = "{}.{}.tmp".format(key_file, os.getpid())
+    with open(tmp_file, "w") as out:
+        out.write(key)
+    os.replace(tmp_file, key_file)
@@ -1,10 +1,12 @@
-from typing import Optional, Callable, Any, List, Tuple
+import os
+from collections import Counter
+from typing import Optional, Callable, Any, List, Tuple, Dict
 
-import mdtraj as md
 import numpy as np
 from dataclasses import dataclass
 
 from .. import log
+from ..utils import topology
 
 _log = log.getLogger(__name__)
 
@@ -20,6 +22,7 @@ class CV(object):
     norm_offset: Optional[float] = 0
     norm_scale: Optional[float] = 1
     importance: Optional[float] = 1
+    statistics: Optional[Dict[str, Any]] = None  # statistics of the CV values the normalization was computed from
 
     def __post_init__(self):
         if self.name is None:
@@ -71,6 +74,25 @@ class CV(object):
             raise Exception("Field 'generator' has not been set")
         return (self.generator(traj) - self.norm_offset) / self.norm_scale
 
+    def required_atoms(self, top) -> Optional[np.array]:
+        """
+        The atoms in the topology needed to evaluate this CV.
+        A trajectory sliced to (a superset of) these atoms gives the same CV values as the full trajectory.
+
+        :return: atom indices, or None if it is not known which atoms the generator uses
+        """
+        return None
+
+    @property
+    def requires_whole_molecules(self) -> bool:
+        """True if the CV values change when molecules are broken by periodic boundary conditions"""
+        return True
+
+    @property
+    def requires_alignment(self) -> bool:
+        """True if the CV values change when the frames are translated or rotated"""
+        return True
+
 
 @dataclass
 class ContactCv(CV):
@@ -82,23 +104,36 @@ class ContactCv(CV):
     def __post_init__(self):
         self.generator = self.compute_contact
 
-    def compute_contact(self, traj):
-        res1_idx, res2_idx = None, None
-        for residue in traj.topology.residues:
-            if residue.is_protein:
-                if residue.resSeq == self.res1:
-                    res1_idx = residue.index
-                    if res2_idx is not None and res2_idx > -1:
-                        break
-                elif residue.resSeq == self.res2:
-                    res2_idx = residue.index
-                    if res1_idx is not None and res1_idx > -1:
-                        break
+    def required_atoms(self, top) -> Optional[np.array]:
+        query = "protein and resSeq {} {}".format(self.res1, self.res2)
+        if self.scheme == "ca":
+            query += " and name CA"
+        elif self.scheme.endswith("heavy"):
+            query += " and element != H"
+        return topology.select(top, query)
+
+    @property
+    def requires_whole_molecules(self) -> bool:
+        # Minimum image distances do not depend on how the molecule is wrapped
+        return not self.periodic
+
+    @property
+    def requires_alignment(self) -> bool:
+        return False
+
+    def residue_indices(self, top) -> Tuple[int, int]:
+        """The indices in the topology of the residues in contact"""
+        residue_map = topology.protein_residue_indices(top)
+        res1_idx, res2_idx = residue_map.get(self.res1), residue_map.get(self.res2)
         if res1_idx is None:
             raise ValueError("No residue with id {}".format(self.res1))
         if res2_idx is None:
             raise ValueError("No residue with id {}".format(self.res2))
-        dists, atoms = md.compute_contacts(traj, contacts=[[res1_idx, res2_idx]], scheme=self.scheme,
+        return res1_idx, res2_idx
+
+    def compute_contact(self, traj):
+        import mdtraj as md
+        dists, atoms = md.compute_contacts(traj, contacts=[self.residue_indices(traj.topology)], scheme=self.scheme,
                                            periodic=self.periodic)
         return dists
 
@@ -121,21 +156,59 @@ class RmsdCv(CV):
     query: Optional[str] = "protein and element != 'H'"
     reference_structure: Optional = None
     warn_missing_atoms: Optional[bool] = True
+    reference_file: Optional[str] = None  # loaded lazily if no reference_structure is given
+    reference_query: Optional[str] = None  # atoms to keep when loading reference_file
 
     def __post_init__(self):
         self.generator = self.compute_rmsd
+        if self.reference_file is not None:
+            # Resolved now, since the reference is loaded on first use, possibly from another working directory
+            self.reference_file = os.path.abspath(self.reference_file)
+
+    def required_atoms(self, top) -> Optional[np.array]:
+        return topology.select(top, self.query)
+
+    @property
+    def requires_whole_molecules(self) -> bool:
+        return True
+
+    @property
+    def requires_alignment(self) -> bool:
+        return True
+
+    def reference(self):
+        """
+        The reference structure. If it was not set explicitly it is loaded from reference_file on first use
+        and shared with all other RmsdCvs in the process with the same reference file and query.
+        """
+        if self.reference_structure is not None:
+            return self.reference_structure
+        if self.reference_file is None:
+            raise Exception("Neither 'reference_structure' nor 'reference_file' has been set")
+        return load_reference_structure(self.reference_file, self.reference_query)
 
     def compute_rmsd(self, traj):
+        import mdtraj as md
         simu_atoms, ref_atoms = self.select_atoms_incommon(traj.topology)
-        rmsds = md.rmsd(traj.atom_slice(simu_atoms), self.reference_structure.atom_slice(ref_atoms))
+        rmsds = md.rmsd(traj, self.reference(), atom_indices=simu_atoms, ref_atom_indices=ref_atoms)
         return rmsds
 
-    def select_atoms_incommon(self, top):
+    def select_atoms_incommon(self, top) -> Tuple[np.array, np.array]:
         """
-        Matches atoms returned by the query for both topologies by name and returns the atom indices for the respective topology
+        Matches atoms returned by the query for both topologies by name and returns the atom indices for the respective topology.
+        The result is memoized per topology fingerprint, reference topology fingerprint and query.
         """
-        atoms = [top.atom(idx) for idx in top.select(self.query)]
-        ref_atoms = [self.reference_structure.top.atom(idx) for idx in self.reference_structure.top.select(self.query)]
+        ref_top = self.reference().top
+        key = (topology.fingerprint(top), topology.fingerprint(ref_top), self.query)
+        indices = _atoms_incommon_cache.get(key)
+        if indices is None:
+            indices = self._match_atoms(top, ref_top)
+            _atoms_incommon_cache[key] = indices
+        return indices
+
+    def _match_atoms(self, top, ref_top) -> Tuple[np.array, np.array]:
+        atoms = [top.atom(idx) for idx in topology.select(top, self.query)]
+        ref_atoms = [ref_top.atom(idx) for idx in topology.select(ref_top, self.query)]
         ref_atoms, missing_atoms = _filter_atoms(ref_atoms, atoms)
         if self.warn_missing_atoms and len(missing_atoms) > 0:
             _log.warn("%s atoms in reference not found topology. They will be ignored. %s", len(
@@ -153,29 +226,47 @@ class RmsdCv(CV):
         if self.warn_missing_atoms and len(atoms) != len(ref_atoms):
             _log.warn("number of atoms in result differ: %s vs %s",
                       len(atoms), len(ref_atoms))
-        return [a.index for a in atoms], [a.index for a in ref_atoms]
+        return np.array([a.index for a in atoms], dtype=int), np.array([a.index for a in ref_atoms], dtype=int)
+
+
+_atoms_incommon_cache = {}
+_reference_cache = {}
+
+
+def load_reference_structure(filepath: str, query: Optional[str] = None):
+    """
+    Loads a reference structure, sliced to the atoms in query, once per process
+    """
+    key = (os.path.abspath(filepath), query)
+    reference = _reference_cache.get(key)
+    if reference is None:
+        import mdtraj as md
+        _log.debug("Loading reference structure %s", filepath)
+        reference = md.load(filepath)
+        if query is not None:
+            reference = reference.atom_slice(topology.select(reference.top, query))
+        _reference_cache[key] = reference
+    return reference
 
 
 def _find_duplicates(atoms):
     atom_names = [str(a) for a in atoms]
-    return [a for a in atoms if atom_names.count(str(a)) > 1]
+    counts = Counter(atom_names)
+    return [a for a, name in zip(atoms, atom_names) if counts[name] > 1]
 
 
 def _filter_atoms(atoms, ref_atoms):
     """
     Returns atoms which name matched the name i ref_atoms as well as the once which did not match.
     Matching is done on name, i.e. str(atom)
-    TODO speed up with a search tree or hashmap
     """
-    ref_atom_names = [str(a) for a in ref_atoms]
+    ref_atom_names = set(str(a) for a in ref_atoms)
     missing_atoms = []
     matching_atoms = []
     # Atoms in inactive not in simu
     for atom in atoms:
         if str(atom) not in ref_atom_names:
-            # print(atom)
             missing_atoms.append(atom)
         else:
-            # print("FOUND IT", atom)
             matching_atoms.append(atom)
     return matching_atoms, missing_atoms
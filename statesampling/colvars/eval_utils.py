@@ -1,59 +1,196 @@
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any
+
 import numpy as np
 
+from .cvs import ContactCv, InverseContactCv
+
 
 def eval_cvs(cvs, traj, rescale=False):
     res = np.empty((len(traj), len(cvs)))
+    contact_indices = []
     for i, cv in enumerate(cvs):
-        res[:, i] = np.squeeze(cv.eval(traj))
-    return rescale_evals(res, cvs) if rescale else res
+        if _is_batchable_contact(cv):
+            contact_indices.append(i)
+        else:
+            res[:, i] = np.squeeze(cv.eval(traj))
+    if len(contact_indices) > 0:
+        res[:, contact_indices] = eval_contact_cvs([cvs[i] for i in contact_indices], traj)
+    return rescale_evals(cvs, res, out=res) if rescale else res
 
 
-def rescale_evals(cvs, evals):
-    if len(evals.shape) == 1:
-        return cvs[0].rescale(evals)
-    res = np.empty(evals.shape)
+def eval_contact_cvs(cvs, traj):
+    """
+    Evaluates ContactCvs and InverseContactCvs together.
+    Contacts with the same scheme and periodicity are computed in one call to md.compute_contacts.
+
+    :return: the normalized CV values, same as eval_cvs, as an array of shape (n_frames, n_cvs)
+    """
+    import mdtraj as md
+    res = np.empty((len(traj), len(cvs)))
+    groups = {}
+    for i, cv in enumerate(cvs):
+        groups.setdefault((cv.scheme, cv.periodic), []).append(i)
+    for (scheme, periodic), indices in groups.items():
+        contacts = [cvs[i].residue_indices(traj.topology) for i in indices]
+        dists, _ = md.compute_contacts(traj, contacts=contacts, scheme=scheme, periodic=periodic)
+        res[:, indices] = dists
     for i, cv in enumerate(cvs):
-        res[:, i] = cv.rescale(evals[:, i])
+        if isinstance(cv, InverseContactCv):
+            res[:, i] = 1 / res[:, i]
+        res[:, i] = (res[:, i] - cv.norm_offset) / cv.norm_scale
     return res
 
 
-def scale_evals(cvs, evals):
+def _is_batchable_contact(cv):
+    """Subclasses may override the generator, so only the exact contact classes are evaluated in batches"""
+    return type(cv) in (ContactCv, InverseContactCv)
+
+
+def normalization_vectors(cvs):
+    """
+    :return: tuple (scale, offset) with the norm_scale and norm_offset of every CV, for broadcasting against evals
+    """
+    scale = np.array([cv.norm_scale for cv in cvs], dtype=float)
+    offset = np.array([cv.norm_offset for cv in cvs], dtype=float)
+    return scale, offset
+
+
+def _rescale(values, scale, offset, out=None):
+    out = np.multiply(values, scale, out=out)
+    out += offset
+    return out
+
+
+def _scale(values, scale, offset, out=None):
+    out = np.subtract(values, offset, out=out)
+    out /= scale
+    return out
+
+
+def rescale_evals(cvs, evals, out=None):
+    """
+    Scales CV values of shape (n_frames, n_cvs) back to physical values.
+    A 1D array is treated as the values of the first CV for every frame.
+
+    :param out: optional array to write the result to. May be evals itself to rescale in place
+    """
+    if len(evals.shape) == 1:
+        return _rescale(evals, cvs[0].norm_scale, cvs[0].norm_offset, out=out)
+    return _rescale(evals, *normalization_vectors(cvs), out=out)
+
+
+def scale_evals(cvs, evals, out=None):
     """The opposite of rescale_evals"""
     if len(evals.shape) == 1:
-        return cvs[0].scale(evals)
-    res = np.empty(evals.shape)
-    for i, cv in enumerate(cvs):
-        res[:, i] = cv.scale(evals[:, i])
-    return res
+        return _scale(evals, cvs[0].norm_scale, cvs[0].norm_offset, out=out)
+    return _scale(evals, *normalization_vectors(cvs), out=out)
 
 
-def normalize_cvs(cvs, simulations=None, trajs=None):
+def normalize_cvs(cvs, simulations=None, trajs=None, scheme="minmax"):
+    """
+    Normalizes all CVs in a single pass over the trajectories.
+    The trajectories may be a generator, e.g. chunks from utils.trajs.iterload_traj_for_regex,
+    so that they never have to be in memory at the same time.
+
+    :param scheme: 'minmax' scales the CVs to values between 0 and 1, 'zscore' to zero mean and unit variance
+    :return: the CVs. Their statistics are stored in cv.statistics and saved with colvars.io.save_cvs
+    """
     if simulations is not None and trajs is None:
-        trajs = [s.traj for s in simulations]
+        trajs = (s.traj for s in simulations)
     if trajs is not None:
-        for cv in cvs:
-            cv.normalize(trajs)
+        stats = compute_cv_statistics(cvs, trajs)
+        if stats.n_frames > 0:
+            stats.apply(cvs, scheme=scheme)
     return cvs
 
 
-def rescale_points(cvs, points):
-    if len(points.shape) == 1:
-        return np.array([cv.rescale(p) for cv, p in zip(cvs, points)])
-    else:
-        res = np.empty(points.shape)
-        for i, point in enumerate(points):
-            for j, cv in enumerate(cvs):
-                res[i, j] = cv.rescale(point[j])
-        return res
+def compute_cv_statistics(cvs, trajs):
+    """Running statistics of the physical, i.e. unnormalized, CV values over all frames in the trajectories"""
+    stats = CvStatistics(n_cvs=len(cvs))
+    for t in trajs:
+        stats.update(eval_cvs(cvs, t, rescale=True))
+    return stats
+
+
+@dataclass
+class CvStatistics(object):
+    """
+    Running min, max, mean and variance per CV, updated one batch of frames at a time
+    """
+    n_cvs: int
+    n_frames: Optional[int] = 0
+    min: Optional[np.array] = None
+    max: Optional[np.array] = None
+    mean: Optional[np.array] = None
+    m2: Optional[np.array] = field(default=None, repr=False)  # sum of squared deviations from the mean
+
+    def update(self, values: np.array) -> None:
+        """
+        :param values: array of shape (n_frames, n_cvs)
+        """
+        n = len(values)
+        if n == 0:
+            return
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+        if self.n_frames == 0:
+            self.min, self.max = values.min(axis=0), values.max(axis=0)
+            self.mean, self.m2 = batch_mean, batch_m2
+        else:
+            # Merge the batch with the running statistics (Chan et al.)
+            total = self.n_frames + n
+            delta = batch_mean - self.mean
+            self.mean = self.mean + delta * n / total
+            self.m2 = self.m2 + batch_m2 + delta ** 2 * self.n_frames * n / total
+            self.min = np.minimum(self.min, values.min(axis=0))
+            self.max = np.maximum(self.max, values.max(axis=0))
+        self.n_frames += n
+
+    @property
+    def variance(self) -> np.array:
+        return self.m2 / self.n_frames
+
+    def normalization(self, scheme="minmax"):
+        """
+        :return: tuple (scale, offset) arrays to normalize the CVs with
+        """
+        if scheme == "minmax":
+            # Same as CV.normalize
+            scale = np.where(self.max > self.min + 1e-4, self.max - self.min, self.max)
+            return scale, self.min.copy()
+        elif scheme == "zscore":
+            std = np.sqrt(self.variance)
+            return np.where(std > 1e-12, std, 1.), self.mean.copy()
+        else:
+            raise ValueError("{} is not a valid normalization scheme".format(scheme))
+
+    def to_dict(self, cv_idx: int) -> Dict[str, Any]:
+        return {
+            "n_frames": int(self.n_frames),
+            "min": float(self.min[cv_idx]),
+            "max": float(self.max[cv_idx]),
+            "mean": float(self.mean[cv_idx]),
+            "variance": float(self.variance[cv_idx])
+        }
+
+    def apply(self, cvs, scheme="minmax") -> None:
+        """Sets norm_scale, norm_offset and statistics for every CV"""
+        scale, offset = self.normalization(scheme)
+        for i, cv in enumerate(cvs):
+            cv.normalize(scale=float(scale[i]), offset=float(offset[i]))
+            cv.statistics = dict(self.to_dict(i), scheme=scheme)
+
+
+def rescale_points(cvs, points, out=None):
+    """
+    Scales points back to physical values. A 1D array is treated as a single point with one value per CV
+
+    :param out: optional array to write the result to. May be points itself to rescale in place
+    """
+    return _rescale(points, *normalization_vectors(cvs), out=out)
 
 
-def scale_points(cvs, points):
+def scale_points(cvs, points, out=None):
     """THe opposite of rescale_points"""
-    if len(points.shape) == 1:
-        return np.array([cv.scale(p) for cv, p in zip(cvs, points)])
-    else:
-        res = np.empty(points.shape)
-        for i, point in enumerate(points):
-            for j, cv in enumerate(cvs):
-                res[i, j] = cv.scale(point[j])
-        return res
+    return _scale(points, *normalization_vectors(cvs), out=out)
@@ -1,12 +1,13 @@
+import hashlib
 import json
 import os
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 import numpy as np
 
 from .. import log
 import statesampling.utils as utils
-from .cvs import CV, InverseContactCv, ContactCv
+from .cvs import CV, InverseContactCv, ContactCv, RmsdCv
 
 _log = log.getLogger("colvars-io")
 
@@ -28,13 +29,14 @@ def load_cvs(filepath: str) -> np.array:
     :return:
     """
     defs = load_cvs_definition(filepath)
-    return create_cvs(defs)
+    return create_cvs(defs, base_dir=os.path.dirname(filepath))
 
 
-def create_cvs(cvs_definition: Dict[str, Any]) -> np.array:
+def create_cvs(cvs_definition: Dict[str, Any], base_dir: Optional[str] = None) -> np.array:
     """
     Create cv objects from definitions of standard types such as float, strings and ints defined as json objects
     :param cvs_definition: JSONs as loaded by function load_cvs_definition
+    :param base_dir: directory relative file paths in the definitions are resolved against
     :return: an numpy array of cvs.py
     """
     cvs = []
@@ -44,11 +46,14 @@ def create_cvs(cvs_definition: Dict[str, Any]) -> np.array:
             cv = _parse_InverseContactCv(cv_def)
         elif clazz == ContactCv.__name__:
             cv = _parse_ContactCv(cv_def)
+        elif clazz == RmsdCv.__name__:
+            cv = _parse_RmsdCv(cv_def, base_dir)
         else:
             _log.warn("Class %s cannot be parsed right now (index %s, json %s). Please implement.", clazz, i, cv_def)
             continue
         cv.name = cv_def.get("name", cv.id)
         cv.importance = cv_def.get("importance", None)
+        cv.statistics = cv_def.get("statistics", None)
         cv.normalize(scale=cv_def.get("scale", 1.), offset=cv_def.get("offset", 0.))
         cvs.append(cv)
 
@@ -95,16 +100,45 @@ def create_cvs_definitions(cvs: List[CV]) -> Dict[str, Any]:
             "importance": cv.importance if hasattr(cv, "importance") else None
 
         }
+        if getattr(cv, "statistics", None) is not None:
+            cv_def["statistics"] = cv.statistics
+        if not _can_serialize(cv):
+            _log.warning("Class %s cannot be parsed right now (cv %s). Please implement.", clazz, cv.id)
+            continue
         if clazz == ContactCv or clazz == InverseContactCv:  # InveseContact and Contact use same serializer
             _serialize_ContactCv(cv, cv_def)
         else:
-            _log.warn("Class %s cannot be parsed right now (cv). Please implement.", clazz, cv)
-            continue
+            _serialize_RmsdCv(cv, cv_def)
         cvs_def.append(cv_def)
     cvs_def = {"cvs": cvs_def}
     return json.dumps(cvs_def, ensure_ascii=False, indent=2)
 
 
+def cvs_fingerprint(cvs: List[CV]) -> Optional[str]:
+    """
+    A hash of the serialized CV definitions and of the size and modification time of the reference files of RmsdCvs,
+    used to detect when stored CV values have become stale
+    :param cvs
+    :return: a hex digest, or None if some CVs cannot be serialized and thus cannot be fingerprinted reliably
+    """
+    if not all(_can_serialize(cv) for cv in cvs):
+        return None
+    cvs_definition = create_cvs_definitions(cvs)
+    h = hashlib.sha1(cvs_definition.encode("utf-8"))
+    for cv in cvs:
+        if isinstance(cv, RmsdCv):
+            # The reference structure may be replaced without its path changing
+            stat = os.stat(cv.reference_file)
+            h.update("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _can_serialize(cv: CV) -> bool:
+    clazz = cv.__class__
+    # An RmsdCv created from a structure in memory cannot be restored from its definition
+    return clazz == ContactCv or clazz == InverseContactCv or (clazz == RmsdCv and cv.reference_file is not None)
+
+
 def _serialize_ContactCv(cv, cv_def):
     cv_def.update({
         "res1": cv.res1,
@@ -114,6 +148,15 @@ def _serialize_ContactCv(cv, cv_def):
     })
 
 
+def _serialize_RmsdCv(cv, cv_def):
+    cv_def.update({
+        "query": cv.query,
+        "reference_file": cv.reference_file,
+        "reference_query": cv.reference_query,
+        "warn_missing_atoms": cv.warn_missing_atoms
+    })
+
+
 def _parse_InverseContactCv(cv_def):
     cv = InverseContactCv(ID=cv_def["id"], res1=cv_def["res1"], res2=cv_def["res2"],
                           scheme=cv_def.get("scheme", "closest-heavy"),
@@ -126,3 +169,16 @@ def _parse_ContactCv(cv_def):
                    scheme=cv_def.get("scheme", "closest-heavy"),
                    periodic=cv_def.get("periodic", True))
     return cv
+
+
+def _parse_RmsdCv(cv_def, base_dir=None):
+    reference_file = cv_def["reference_file"]
+    if base_dir is not None and not os.path.isabs(reference_file):
+        # Absolute so that the path stays valid if the CVs are saved elsewhere or the working directory changes
+        reference_file = os.path.abspath(os.path.join(base_dir, reference_file))
+    cv = RmsdCv(ID=cv_def["id"],
+                query=cv_def.get("query", "protein and element != 'H'"),
+                reference_file=reference_file,
+                reference_query=cv_def.get("reference_query", None),
+                warn_missing_atoms=cv_def.get("warn_missing_atoms", True))
+    return cv
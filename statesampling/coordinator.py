@@ -0,0 +1,113 @@
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Optional, List, Callable
+
+from . import log
+from .iteration_runner import IterationRunner
+from .utils.io import makedirs, working_directory
+
+_log = log.getLogger(__name__)
+
+
+@dataclass
+class SamplingRun(object):
+    """
+    The iterations of one sampling run, e.g. of one ligand and exploration type, advanced step by step by a Coordinator.
+    Every step does as much as possible without blocking: submitting the walkers of an iteration,
+    checking them once or postprocessing the iteration once the CVs of all finished walkers have been evaluated.
+    """
+    name: str
+    working_dir: str  # absolute path of the directory with one subdirectory per iteration
+    iteration: int
+    max_iteration: int
+    create_runner: Callable[[int], IterationRunner]  # creates the runner of an iteration
+    center_points: List = field(default_factory=list)
+    center_variances: List = field(default_factory=list)  # of the center_points, see IterationRunner.center_variance
+    _runner: Optional[IterationRunner] = field(default=None, init=False, repr=False)
+    _state: str = field(default="start", init=False, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self._state in ("finished", "failed")
+
+    @property
+    def failed(self) -> bool:
+        return self._state == "failed"
+
+    def step(self) -> None:
+        if self.finished:
+            return
+        iteration_dir = os.path.join(self.working_dir, str(self.iteration))
+        makedirs(iteration_dir, overwrite=False)
+        with working_directory(iteration_dir):
+            if self._state == "start":
+                self._start_iteration()
+            if self._state == "waiting" and self._runner.poll():
+                self._runner.finish_waiting()
+                self._state = "analyzing"
+            if self._state == "analyzing":
+                self._runner.collect_evaluations()
+                if not self._runner.evaluations_pending():
+                    self._finish_iteration()
+
+    def _start_iteration(self) -> None:
+        self._runner = self.create_runner(self.iteration)
+        checkpoint = self._runner.checkpoint()
+        if checkpoint.seeded or checkpoint.analyzed:
+            _log.info("Run %s resumes iteration %s from its checkpoint", self.name, self.iteration)
+        elif checkpoint.finished_walkers is not None:
+            # Evaluate the walkers in the background rather than when postprocessing
+            self._runner.finish_waiting()
+        else:
+            self._runner.submit_jobs()
+            self._state = "waiting"
+            return
+        self._state = "analyzing"
+
+    def _finish_iteration(self) -> None:
+        runner = self._runner
+        runner.postprocess()
+        center, _ = runner.compute_center_distances()
+        self.center_points.append(center)
+        self.center_variances.append(runner.center_variance())
+        if runner.collect_metrics:
+            runner.metrics.save()
+        _log.info("Run %s finished iteration %s", self.name, self.iteration)
+        self._runner = None
+        self.iteration += 1
+        self._state = "finished" if self.iteration > self.max_iteration else "start"
+
+    def fail(self) -> None:
+        self._runner = None
+        self._state = "failed"
+
+
+@dataclass
+class Coordinator(object):
+    """
+    Drives many sampling runs from a single process and event loop.
+    Each tick, every run lists its iteration directory once to find finished walkers.
+    The runs' runners should share one bounded analysis_pool so that the CVs of all runs are evaluated by
+    a fixed number of processes.
+    """
+    runs: List[SamplingRun]
+    seconds_to_sleep: Optional[float] = 3
+
+    def run(self) -> None:
+        _log.info("Coordinating %s runs", len(self.runs))
+        while not all(r.finished for r in self.runs):
+            for r in self.runs:
+                if r.finished:
+                    continue
+                try:
+                    r.step()
+                except Exception:
+                    # A failing run should not stop the others
+                    _log.exception("Run %s failed in iteration %s", r.name, r.iteration)
+                    r.fail()
+            time.sleep(self.seconds_to_sleep)
+        failed = [r.name for r in self.runs if r.failed]
+        if len(failed) > 0:
+            _log.error("Runs %s failed", failed)
+        _log.info("All runs finished")
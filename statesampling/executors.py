@@ -0,0 +1,251 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Iterable, Set, Tuple
+
+from . import log
+from .utils import slurm
+
+_log = log.getLogger(__name__)
+
+
+class WalkerExecutor(object):
+    """
+    Backend which runs the walker script for a set of walker indices in the current iteration directory.
+    The script gets the walker index in the environment variable SLURM_ARRAY_TASK_ID.
+    """
+
+    def submit(self, walker_indices: Iterable[int]) -> None:
+        raise NotImplementedError()
+
+    def finished(self, walker_idx: int) -> bool:
+        """True if the walker has finished successfully"""
+        return os.path.exists("s{}.done".format(walker_idx))
+
+    def finished_walkers(self, walker_indices: Iterable[int], files: Optional[Set[str]] = None) -> List[int]:
+        """
+        The walkers among walker_indices which have finished successfully
+        :param files: names of the files in the iteration directory, listed once for all walkers.
+        Listed here if not set
+        """
+        if files is None:
+            files = set(os.listdir("."))
+        return [i for i in walker_indices if "s{}.done".format(i) in files]
+
+    def stopped_walkers(self, walker_indices: Iterable[int]) -> List[int]:
+        """
+        :return: the walkers among walker_indices which were submitted by this executor but are no longer running,
+        whether they finished or not
+        """
+        return []
+
+    def cancel(self, walker_indices: Iterable[int]) -> None:
+        pass
+
+    def jobs(self) -> Dict[int, str]:
+        """
+        :return: the ids of the jobs running the submitted walkers, which another executor can keep tracking after a
+        restart with restore_jobs. Walkers without a job id cannot be tracked across restarts.
+        """
+        return {}
+
+    def restore_jobs(self, jobs: Dict[int, str]) -> None:
+        """Tracks walkers submitted before a restart, as returned by jobs()"""
+        pass
+
+    def wait(self, timeout: float) -> None:
+        """Blocks for at most timeout seconds, or until some walker might have changed state"""
+        time.sleep(timeout)
+
+    def shutdown(self) -> None:
+        pass
+
+
+@dataclass
+class SlurmExecutor(WalkerExecutor):
+    """
+    Submits the walkers as a SLURM job array. Completion is detected through the s{i}.done files written by the script
+    """
+    script: Optional[str] = "../submit_walkers.sh"
+    _walker_jobs: Dict[int, str] = field(default_factory=dict, init=False, repr=False)
+
+    def submit(self, walker_indices: Iterable[int]) -> None:
+        walker_indices = list(walker_indices)
+        job_id = slurm.submit_array(self.script, walker_indices)
+        for i in walker_indices:
+            if job_id is None:
+                self._walker_jobs.pop(i, None)
+            else:
+                self._walker_jobs[i] = job_id
+
+    def stopped_walkers(self, walker_indices: Iterable[int]) -> List[int]:
+        walker_indices = [i for i in walker_indices if i in self._walker_jobs]
+        queued_tasks = {}
+        for job_id in set(self._walker_jobs[i] for i in walker_indices):
+            queued_tasks[job_id] = slurm.queued_array_tasks(job_id)
+        stopped = []
+        for i in walker_indices:
+            tasks = queued_tasks[self._walker_jobs[i]]
+            if tasks is not None and i not in tasks:
+                stopped.append(i)
+        return stopped
+
+    def cancel(self, walker_indices: Iterable[int]) -> None:
+        jobs = {}
+        for i in walker_indices:
+            job_id = self._walker_jobs.pop(i, None)
+            if job_id is not None:
+                jobs.setdefault(job_id, []).append(i)
+        for job_id, indices in jobs.items():
+            slurm.cancel_array_tasks(job_id, indices)
+
+    def jobs(self) -> Dict[int, str]:
+        return dict(self._walker_jobs)
+
+    def restore_jobs(self, jobs: Dict[int, str]) -> None:
+        self._walker_jobs.update(jobs)
+
+
+@dataclass
+class LocalExecutor(WalkerExecutor):
+    """
+    Runs the walker script locally for every walker index, at most max_workers at a time.
+    Completion is reported by the process exit code and s{i}.done is created for walkers which exit successfully.
+    Walkers are tracked per iteration directory, so one executor can be used for all iterations.
+    Every walker runs in its own process group, so that cancelling it also stops the processes started by the script.
+    """
+    script: Optional[str] = "../submit_walkers.sh"
+    max_workers: Optional[int] = None
+    shell: Optional[str] = "/bin/bash"
+    _pool: Optional[ThreadPoolExecutor] = field(default=None, init=False, repr=False)
+    _futures: Dict[Tuple[str, int], Future] = field(default_factory=dict, init=False, repr=False)
+    _processes: Dict[Tuple[str, int], subprocess.Popen] = field(default_factory=dict, init=False, repr=False)
+    # Set when a submitted walker is cancelled, one per submission so that a resubmitted walker is not affected
+    _cancelled: Dict[Tuple[str, int], threading.Event] = field(default_factory=dict, init=False, repr=False)
+    # Guards _processes and _cancelled, so that a walker cancelled while its thread starts it is never left running
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def submit(self, walker_indices: Iterable[int]) -> None:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers or os.cpu_count())
+        cwd = os.getcwd()
+        for i in walker_indices:
+            cancelled = threading.Event()
+            with self._lock:
+                self._cancelled[(cwd, i)] = cancelled
+            self._futures[(cwd, i)] = self._pool.submit(self._run_walker, i, cwd, cancelled)
+
+    def _run_walker(self, walker_idx: int, cwd: str, cancelled: threading.Event) -> int:
+        key = (cwd, walker_idx)
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(walker_idx))
+        with self._lock:
+            if cancelled.is_set():
+                return -signal.SIGTERM
+            proc = subprocess.Popen([self.shell, self.script], cwd=cwd, env=env, start_new_session=True)
+            self._processes[key] = proc
+        returncode = proc.wait()
+        with self._lock:
+            if self._processes.get(key) is proc:
+                del self._processes[key]
+            if self._cancelled.get(key) is cancelled:
+                del self._cancelled[key]
+        if returncode == 0:
+            with open(os.path.join(cwd, "s{}.done".format(walker_idx)), "a"):
+                pass
+        else:
+            _log.warning("Walker %s exited with code %s", walker_idx, returncode)
+        return returncode
+
+    def _future(self, walker_idx: int) -> Optional[Future]:
+        return self._futures.get((os.getcwd(), walker_idx))
+
+    def finished(self, walker_idx: int) -> bool:
+        future = self._future(walker_idx)
+        if future is None:
+            # Not run by this executor, e.g. finished before a restart
+            return super().finished(walker_idx)
+        return self._succeeded(future)
+
+    def finished_walkers(self, walker_indices: Iterable[int], files: Optional[Set[str]] = None) -> List[int]:
+        walker_indices = list(walker_indices)
+        not_run = [i for i in walker_indices if self._future(i) is None]
+        # Walkers not run by this executor finished before a restart, if at all
+        finished = set(super().finished_walkers(not_run, files)) if len(not_run) > 0 else set()
+        return [i for i in walker_indices if i in finished or self._succeeded(self._future(i))]
+
+    @staticmethod
+    def _succeeded(future: Optional[Future]) -> bool:
+        return future is not None and future.done() and not future.cancelled() and future.exception() is None \
+               and future.result() == 0
+
+    def stopped_walkers(self, walker_indices: Iterable[int]) -> List[int]:
+        return [i for i in walker_indices if self._future(i) is not None and self._future(i).done()]
+
+    def cancel(self, walker_indices: Iterable[int]) -> None:
+        cwd = os.getcwd()
+        for i in walker_indices:
+            future = self._futures.pop((cwd, i), None)
+            if future is not None:
+                future.cancel()
+            with self._lock:
+                cancelled = self._cancelled.pop((cwd, i), None)
+                if cancelled is not None:
+                    cancelled.set()
+                proc = self._processes.get((cwd, i))
+                if proc is not None:
+                    self._kill(proc)
+
+    @staticmethod
+    def _kill(proc: subprocess.Popen) -> None:
+        """Terminates the walker script and every process it started"""
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            # Already exited
+            pass
+
+    def wait(self, timeout: float) -> None:
+        pending = [f for f in self._futures.values() if not f.done()]
+        if len(pending) == 0:
+            time.sleep(timeout)
+        else:
+            wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+    def shutdown(self) -> None:
+        for future in self._futures.values():
+            future.cancel()
+        with self._lock:
+            for cancelled in self._cancelled.values():
+                cancelled.set()
+            self._cancelled.clear()
+            for proc in self._processes.values():
+                self._kill(proc)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+def create_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    A process pool, e.g. to evaluate CVs, with all its worker processes started right away.
+    A worker forked while a LocalExecutor thread starts a walker inherits the pipes of the walker process,
+    which blocks the thread until the pool shuts down.
+    """
+    pool = ProcessPoolExecutor(max_workers=max_workers)
+    # Submitting the first task starts all workers
+    pool.submit(int).result()
+    return pool
+
+
+def create_executor(name: str, script: Optional[str] = "../submit_walkers.sh",
+                    max_workers: Optional[int] = None) -> WalkerExecutor:
+    if name == "slurm":
+        return SlurmExecutor(script=script)
+    elif name == "local":
+        return LocalExecutor(script=script, max_workers=max_workers)
+    else:
+        raise ValueError("{} is not a valid executor".format(name))
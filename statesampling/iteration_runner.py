@@ -1,21 +1,88 @@
+import cProfile
+import json
 import os
-import shutil
-import subprocess
 import time
-from dataclasses import dataclass
-from functools import reduce
-from typing import Optional, List, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, Future, as_completed
+from dataclasses import dataclass, field
+from typing import Optional, List, Tuple, Dict, Set, Iterator
 
 import numpy as np
-from scipy.special import expit
 
 from . import log, colvars
-from .utils.io import makedirs
-from .utils.trajs import load_traj_for_regex
+from .checkpoint import IterationCheckpoint
+from .executors import WalkerExecutor, SlurmExecutor, create_process_pool
+from .metrics import Metrics
+from .store import CvStore
+from .utils.io import makedirs, link_or_copy
+from .summaries import WalkerSummary, CENTER_WEIGHTINGS, estimate_center, distances_to_center
+from .walkers import evaluate_walker, evaluate_walker_with_metrics
 
 _log = log.getLogger(__name__)
 
 
+def compute_weights(distance_to_center: np.array, exploration_type: str) -> np.array:
+    """
+    The relative probability for every walker to seed new walkers given its endpoint's distance to the center.
+    Single state exploration favors walkers close to the center while multi state exploration favors distant ones.
+    """
+    distance_to_center = np.asarray(distance_to_center, dtype=float)
+    mean_dist = distance_to_center.mean()
+    if mean_dist > 0:
+        relative_dist = (distance_to_center / mean_dist) ** 2
+    else:
+        # All endpoints coincide with the center
+        relative_dist = np.ones(distance_to_center.shape)
+    if "single" in exploration_type:
+        return np.exp(-relative_dist)
+    elif "multi" in exploration_type:
+        # The logistic function, same as scipy.special.expit
+        return 1 / (1 + np.exp(-relative_dist))
+    else:
+        raise ValueError("{} is not a valid exploration type".format(exploration_type))
+
+
+REPLICA_ALLOCATIONS = ("largest_remainder", "residual", "systematic")
+
+
+def allocate_replicas(weights: np.array, n_replicas: int, method: Optional[str] = "largest_remainder",
+                      rng: Optional[np.random.RandomState] = None) -> np.array:
+    """
+    Distributes exactly n_replicas replicas over the walkers in proportion to their weights
+    :param weights: as returned by compute_weights
+    :param n_replicas:
+    :param method: 'largest_remainder' rounds every walker's expected number of replicas down and gives the remaining
+    replicas to the walkers with the largest remainders. 'residual' draws the remaining replicas at random
+    in proportion to the remainders and 'systematic' uses systematic resampling. The last two need rng to be reproducible
+    :param rng:
+    :return: the number of replicas of every walker
+    """
+    if method not in REPLICA_ALLOCATIONS:
+        raise ValueError("{} is not a valid replica allocation method".format(method))
+    weights = np.asarray(weights, dtype=float)
+    if len(weights) == 0 or weights.sum() <= 0 or not np.all(np.isfinite(weights)):
+        raise ValueError("Cannot allocate replicas with weights {}".format(weights))
+    if rng is None:
+        rng = np.random.RandomState()
+    probabilities = weights / weights.sum()
+    if method == "systematic":
+        positions = (rng.uniform() + np.arange(n_replicas)) / n_replicas
+        cumulative = np.cumsum(probabilities)
+        cumulative[-1] = 1.
+        return np.bincount(np.searchsorted(cumulative, positions, side="right"), minlength=len(weights))
+    expected = n_replicas * probabilities
+    counts = np.floor(expected).astype(int)
+    remainders = expected - counts
+    n_remaining = n_replicas - counts.sum()
+    if n_remaining <= 0:
+        return counts
+    if method == "largest_remainder":
+        # A stable sort breaks ties in walker order
+        counts[np.argsort(-remainders, kind="mergesort")[:n_remaining]] += 1
+    else:
+        counts += rng.multinomial(n_remaining, remainders / remainders.sum())
+    return counts
+
+
 @dataclass
 class IterationRunner(object):
     iteration: int
@@ -24,117 +91,463 @@ class IterationRunner(object):
     cvs: List[colvars.CV]
     seconds_to_sleep: Optional[int] = 3
     query: Optional[str] = "protein"  # "not (resname =~ 'POP') and not water"
+    n_workers: Optional[int] = 1  # number of processes used to evaluate the walkers' CVs
+    use_cache: Optional[bool] = True  # store evaluated CVs next to the trajectories and reuse them
+    chunk_size: Optional[int] = None  # stream trajectories in chunks of this many frames to bound memory usage
+    incremental_analysis: Optional[bool] = True  # evaluate the CVs of finished walkers while waiting for the others
+    quorum: Optional[int] = None  # advance to the next iteration once this many walkers have finished
+    straggler_timeout_factor: Optional[float] = None  # advance when the wait exceeds this many median completion times
+    max_resubmissions: Optional[int] = 1  # times a walker which left the queue unfinished is resubmitted
+    seconds_between_queue_checks: Optional[int] = 60
+    executor: Optional[WalkerExecutor] = None  # backend running the walkers. Submits to SLURM by default
+    store: Optional[CvStore] = None  # records the CV values and results of the iteration if set
+    use_checkpoint: Optional[bool] = True  # save the progress in the iteration directory and resume from it
+    seed_mode: Optional[str] = "copy"  # how replicas of the same walker are created: 'copy', 'hardlink' or 'symlink'
+    replica_allocation: Optional[str] = "largest_remainder"  # see allocate_replicas
+    seed: Optional[int] = None  # makes stochastic replica allocation reproducible
+    collect_metrics: Optional[bool] = False  # write stage durations and walker metrics to metrics.json when run
+    profile: Optional[bool] = False  # write a cProfile dump of run to profile.prof
+    analysis_pool: Optional[Executor] = None  # evaluates the walkers' CVs if set, e.g. shared by many runners
+    center_weighting: Optional[str] = "frame"  # 'frame' or 'walker', see summaries.walker_weights
+    _cvs_hash: Optional[str] = field(default=None, init=False, repr=False)
+    _walker_evals: Dict[int, Future] = field(default_factory=dict, init=False, repr=False)
+    _walker_summaries: Dict[int, WalkerSummary] = field(default_factory=dict, init=False, repr=False)
+    _executor: Optional[ProcessPoolExecutor] = field(default=None, init=False, repr=False)
+    _resubmissions: Dict[int, int] = field(default_factory=dict, init=False, repr=False)
+    _completion_times: Dict[int, float] = field(default_factory=dict, init=False, repr=False)
+    _submission_time: Optional[float] = field(default=None, init=False, repr=False)
+    _checkpoint: Optional[IterationCheckpoint] = field(default=None, init=False, repr=False)
+    _metrics: Metrics = field(default=None, init=False, repr=False)
+    _last_queue_check: Optional[float] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.executor is None:
+            self.executor = SlurmExecutor()
+        if self.seed_mode not in ("copy", "hardlink", "symlink"):
+            raise ValueError("{} is not a valid seed mode".format(self.seed_mode))
+        if self.center_weighting not in CENTER_WEIGHTINGS:
+            raise ValueError("{} is not a valid center weighting".format(self.center_weighting))
+        if self.replica_allocation not in REPLICA_ALLOCATIONS:
+            raise ValueError("{} is not a valid replica allocation method".format(self.replica_allocation))
+        self._metrics = Metrics(enabled=self.collect_metrics)
+        self._cvs_hash = colvars.io.cvs_fingerprint(self.cvs)
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._metrics
 
     def run(self) -> None:
-        self.submit_jobs()
-        self.wait_for_completion()
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with self._metrics.span("run", iteration=self.iteration):
+                self._run()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats("profile.prof")
+            if self.collect_metrics:
+                self._metrics.save()
+
+    def _run(self) -> None:
+        checkpoint = self.checkpoint()
+        if checkpoint.seeded:
+            _log.info("Iteration %s already seeded the next iteration. Resuming from its checkpoint", self.iteration)
+            return
+        if checkpoint.finished_walkers is None:
+            with self._metrics.span("submit_jobs"):
+                self.submit_jobs()
+            with self._metrics.span("wait_for_completion") as span:
+                self.wait_for_completion()
+                span.set(finished_walkers=len(self.checkpoint().finished_walkers))
         self.postprocess()
 
-    def submit_jobs(self) -> subprocess.Popen:
+    def checkpoint(self) -> IterationCheckpoint:
+        """The checkpoint in the current (iteration) directory, loaded on first use"""
+        if self._checkpoint is None:
+            if self.use_checkpoint:
+                self._checkpoint = IterationCheckpoint.load(self.iteration, self._cvs_hash)
+                self._submission_time = self._checkpoint.submission_time
+                self._resubmissions = dict(self._checkpoint.resubmissions)
+            else:
+                self._checkpoint = IterationCheckpoint(iteration=self.iteration, cvs_hash=self._cvs_hash)
+        return self._checkpoint
+
+    def _save_checkpoint(self) -> None:
+        checkpoint = self.checkpoint()
+        checkpoint.submission_time = self._submission_time
+        checkpoint.resubmissions = dict(self._resubmissions)
+        if checkpoint.finished_walkers is None:
+            checkpoint.jobs = {i: job_id for i, job_id in self.executor.jobs().items() if i in checkpoint.submitted}
+        if self.use_checkpoint:
+            checkpoint.save()
+
+    def submit_jobs(self) -> None:
         if self.simulations_finished():
-            return None
-        args = [
-            "sbatch",
-            "--array=0-{}".format(self.swarm_size - 1),
-            "../submit_walkers.sh"
-        ]
-        return subprocess.Popen(['/bin/bash', '-c', " ".join(args)])
+            return
+        checkpoint = self.checkpoint()
+        if checkpoint.submission_time is not None:
+            self._resume_jobs()
+            return
+        if self.incremental_analysis:
+            # Start the worker processes before any walker process, see create_process_pool
+            self._evaluation_pool()
+        self._submission_time = time.time()
+        self.executor.submit(range(self.swarm_size))
+        checkpoint.submitted = list(range(self.swarm_size))
+        self._save_checkpoint()
+
+    def _resume_jobs(self) -> None:
+        """
+        Keeps tracking the walkers submitted before a restart.
+        Only walkers whose job cannot be tracked by the executor, e.g. local processes, are submitted again
+        """
+        checkpoint = self.checkpoint()
+        unfinished = [i for i in self._unfinished_walkers() if i in checkpoint.submitted]
+        self.executor.restore_jobs({i: checkpoint.jobs[i] for i in unfinished if i in checkpoint.jobs})
+        untracked = [i for i in unfinished if i not in checkpoint.jobs]
+        _log.info("Resuming iteration %s with %s unfinished walkers", self.iteration, len(unfinished))
+        if len(untracked) > 0:
+            _log.warning("Walkers %s cannot be tracked after the restart. Submitting them again", untracked)
+            if self.incremental_analysis:
+                self._evaluation_pool()
+            self.executor.submit(untracked)
+        self._save_checkpoint()
 
     def wait_for_completion(self) -> bool:
         _log.info("Waiting for completion")
-        while not self.simulations_finished():
-            time.sleep(self.seconds_to_sleep)
+        while not self.poll():
+            self.executor.wait(self.seconds_to_sleep)
+        self.finish_waiting()
         return True
 
+    def poll(self) -> bool:
+        """
+        Checks the walkers once without blocking: starts evaluating newly finished walkers
+        and handles the quorum, stragglers and walkers which stopped without finishing.
+        :return: True when the iteration should stop waiting for walkers, see finish_waiting
+        """
+        now = time.time()
+        if self._last_queue_check is None:
+            self._last_queue_check = now
+        done, excluded = self._walker_states()
+        if len(done | excluded) == self.swarm_size:
+            return True
+        finished = sorted(done - excluded)
+        if self._submission_time is not None:
+            for i in finished:
+                if i not in self._completion_times:
+                    self._completion_times[i] = now - self._submission_time
+                    self._metrics.record_walker(i, completed_after_seconds=self._completion_times[i])
+        if self.incremental_analysis:
+            self._evaluate_finished_walkers(finished)
+            self.collect_evaluations()
+        if self._quorum_reached(finished):
+            self._exclude_unfinished_walkers()
+            return True
+        if now - self._last_queue_check >= self.seconds_between_queue_checks:
+            self._handle_lost_walkers()
+            self._last_queue_check = time.time()
+        return False
+
+    def finish_waiting(self) -> None:
+        """Records the walkers which finished the iteration, once poll returned True"""
+        finished = self.finished_walkers()
+        if self.incremental_analysis:
+            self._evaluate_finished_walkers(finished)
+            self.collect_evaluations()
+        if len(finished) == 0:
+            raise ValueError("No walkers finished in iteration {}".format(self.iteration))
+        self.checkpoint().finished_walkers = finished
+        self._save_checkpoint()
+
+    def _quorum_reached(self, finished: List[int]) -> bool:
+        n_finished = len(finished)
+        if self.quorum is not None and n_finished >= self.quorum:
+            _log.info("Quorum reached with %s of %s walkers finished", n_finished, self.swarm_size)
+            return True
+        # Completion times are only known for walkers submitted by this runner
+        if self.straggler_timeout_factor is not None and self._submission_time is not None \
+                and n_finished >= self.swarm_size / 2:
+            median_time = np.median([self._completion_times[i] for i in finished])
+            waited = time.time() - self._submission_time
+            if waited > self.straggler_timeout_factor * median_time:
+                _log.info("Timeout after %s seconds, %s times the median completion time, with %s of %s walkers finished",
+                          waited, self.straggler_timeout_factor, n_finished, self.swarm_size)
+                return True
+        return False
+
+    def _handle_lost_walkers(self) -> None:
+        """Resubmits or excludes the walkers whose job stopped without the walker finishing"""
+        stopped = self.executor.stopped_walkers(self._unfinished_walkers())
+        # Check if the walker is done only after querying the executor since a walker finishes before its job stops
+        unfinished = self._unfinished_walkers()
+        lost = [i for i in stopped if i in unfinished]
+        if len(lost) == 0:
+            return
+        to_resubmit = [i for i in lost if self._resubmissions.get(i, 0) < self.max_resubmissions]
+        to_exclude = [i for i in lost if i not in to_resubmit]
+        if len(to_resubmit) > 0:
+            _log.warning("Walkers %s stopped without finishing. Resubmitting them", to_resubmit)
+            for i in to_resubmit:
+                self._resubmissions[i] = self._resubmissions.get(i, 0) + 1
+            self.executor.submit(to_resubmit)
+        if len(to_exclude) > 0:
+            _log.warning("Walkers %s stopped without finishing too many times. Excluding them", to_exclude)
+            self._exclude_walkers(to_exclude)
+        self._save_checkpoint()
+
+    def _exclude_unfinished_walkers(self) -> None:
+        unfinished = self._unfinished_walkers()
+        if len(unfinished) > 0:
+            _log.warning("Excluding unfinished walkers %s from iteration %s", unfinished, self.iteration)
+            self._exclude_walkers(unfinished)
+
+    def _exclude_walkers(self, walkers: List[int]) -> None:
+        """Marks the walkers as excluded from this iteration and cancels their jobs if they are still running"""
+        for i in walkers:
+            with open("s{}.excluded".format(i), "w"):
+                pass
+        self.executor.cancel(walkers)
+
+    def _walker_states(self) -> Tuple[Set[int], Set[int]]:
+        """
+        The finished and the excluded walkers.
+        The iteration directory is listed once instead of checking the files of every walker
+        """
+        files = set(os.listdir("."))
+        walkers = range(self.swarm_size)
+        done = set(self.executor.finished_walkers(walkers, files))
+        excluded = set(i for i in walkers if "s{}.excluded".format(i) in files)
+        return done, excluded
+
+    def _unfinished_walkers(self) -> List[int]:
+        done, excluded = self._walker_states()
+        return [i for i in range(self.swarm_size) if i not in done and i not in excluded]
+
+    def finished_walkers(self) -> List[int]:
+        """The walkers which finished and were not excluded from the iteration, in walker order"""
+        done, excluded = self._walker_states()
+        return sorted(done - excluded)
+
     def postprocess(self) -> None:
         """Create input for next iteration"""
         _log.info("Postprocessing")
-        center, distance_to_center = self.compute_center_distances()
-        self.generate_replicas(distance_to_center)
+        with self._metrics.span("postprocess"):
+            with self._metrics.span("compute_center_distances"):
+                center, distance_to_center = self.compute_center_distances()
+            with self._metrics.span("generate_replicas"):
+                self.generate_replicas(distance_to_center)
 
     def simulations_finished(self) -> bool:
-        files_missing = False
-        for i in range(self.swarm_size):
-            if not os.path.exists("s{}.done".format(i)):
-                files_missing = True
-                break
-        return not files_missing
+        """True if every walker has either finished or been excluded from the iteration"""
+        return len(self._unfinished_walkers()) == 0
 
     def compute_center_distances(self) -> Tuple[np.array, np.array]:
-        evals = self._load_evals()
-        all_evs = reduce(lambda e1, e2: np.append(e1, e2, axis=0), evals)
-        print(all_evs.shape, evals[0].shape)
-        center = all_evs.mean(axis=0)
-        distance_to_center = np.empty((self.swarm_size,))
-        for idx, ev in enumerate(evals):
-            endpoint = ev[-1]
-            distance_to_center[idx] = np.linalg.norm(center - endpoint)
+        """
+        Summarizes the frames of every finished walker, one walker at a time, and merges the summaries
+        :return: the center of all frames of the finished walkers
+        and the distance to the center from the endpoint of every finished walker, in the order of the finished walkers
+        recorded in the checkpoint
+        """
+        checkpoint = self.checkpoint()
+        if checkpoint.analyzed:
+            return np.array(checkpoint.center), np.array(checkpoint.distance_to_center)
+        # The walkers recorded when waiting ended, even if a straggler has finished since
+        walkers = checkpoint.finished_walkers if checkpoint.finished_walkers is not None else self.finished_walkers()
+        with self._metrics.span("load_evals", walkers=len(walkers)):
+            for walker, evals in self._iter_evals(walkers):
+                self._summarize_walker(walker, evals)
+        summaries = [self._walker_summaries[i] for i in walkers]
+        estimate = estimate_center(summaries, weighting=self.center_weighting)
+        center = estimate.center
+        distance_to_center = distances_to_center(summaries, center)
+        _log.info("Center of %s frames of %s walkers has a standard error of %s",
+                  estimate.n_frames, estimate.n_walkers, estimate.standard_error)
+        for walker, d in zip(walkers, distance_to_center):
+            self._metrics.record_walker(walker, distance_to_center=float(d))
+        if self.store is not None:
+            with self._metrics.span("store"):
+                self.store.append_iteration(self.iteration,
+                                            center=center,
+                                            center_variance=estimate.variance,
+                                            spread=estimate.spread,
+                                            walkers=walkers,
+                                            distance_to_center=distance_to_center)
+        checkpoint.finished_walkers = walkers
+        checkpoint.center = center.tolist()
+        checkpoint.center_variance = estimate.variance.tolist() if estimate.variance is not None else None
+        checkpoint.distance_to_center = distance_to_center.tolist()
+        self._save_checkpoint()
         return center, distance_to_center
 
+    def center_variance(self) -> Optional[np.array]:
+        """
+        :return: the variance of the center per CV, see summaries.estimate_center,
+        once compute_center_distances has run. None with fewer than two finished walkers
+        """
+        variance = self.checkpoint().center_variance
+        return np.array(variance) if variance is not None else None
+
     def generate_replicas(self, distance_to_center: np.array) -> None:
+        """
+        Distributes swarm_size replicas over the finished walkers and seeds the next iteration with them
+        :param distance_to_center: as returned by compute_center_distances, one value per finished walker
+        """
+        checkpoint = self.checkpoint()
+        if checkpoint.seeded:
+            return
         next_iter_dir = "../{}/".format(self.iteration + 1)
-        makedirs(next_iter_dir, overwrite=True, backup=True)
-        n_replicas = self._compute_number_of_replicas(distance_to_center)
+        # The walkers that distance_to_center and the n_replicas of the checkpoint belong to
+        walkers = checkpoint.finished_walkers
+        if checkpoint.n_replicas is None:
+            makedirs(next_iter_dir, overwrite=True, backup=True)
+            n_replicas = self._compute_number_of_replicas(distance_to_center)
+            if self.store is not None:
+                self.store.append_iteration(self.iteration, n_replicas=n_replicas)
+            checkpoint.n_replicas = n_replicas.tolist()
+            self._save_checkpoint()
+        else:
+            # Seeding was interrupted. The directory was created by this iteration so it is reused rather than backed up
+            makedirs(next_iter_dir, overwrite=False)
+            n_replicas = np.array(checkpoint.n_replicas)
         # Iterate through in descending order
-        counter = 0
-        for idx, nreps in enumerate(n_replicas):
-            infile = "s{}.gro".format(idx)
-            _log.info("Trajectory %s will seed %s new replicas", idx, nreps)
-            for n in range(nreps):
-                shutil.copy(infile, "{}in-{}.gro".format(next_iter_dir, counter))
-                counter += 1
+        with self._metrics.span("seed_replicas", seed_mode=self.seed_mode) as span:
+            counter = 0
+            seeds, modes = {}, {}
+            mode = self.seed_mode
+            bytes_written = 0
+            for idx, nreps in zip(walkers, n_replicas):
+                infile = "s{}.gro".format(idx)
+                _log.info("Trajectory %s will seed %s new replicas", idx, nreps)
+                self._metrics.record_walker(idx, n_replicas=int(nreps))
+                first_replica = None
+                for n in range(nreps):
+                    outfile = "{}in-{}.gro".format(next_iter_dir, counter)
+                    if first_replica is None:
+                        # Every structure is written once. The other replicas link to it
+                        used_mode = link_or_copy(infile, outfile, mode="copy")
+                        first_replica = outfile
+                    else:
+                        used_mode = mode = link_or_copy(first_replica, outfile, mode=mode)
+                    if used_mode == "copy" and self.collect_metrics:
+                        bytes_written += os.path.getsize(outfile)
+                    seeds[os.path.basename(outfile)] = int(idx)
+                    modes[os.path.basename(outfile)] = used_mode
+                    counter += 1
+            # Links fall back to copies if the filesystem does not support them
+            span.set(files=counter, bytes_written=bytes_written, seed_mode=mode)
 
         if counter != self.swarm_size:
             _log.error(
                 "Reweighting of replicas tried to copy wrong number of replicas (counter=%s). Double check your code.\ndistances: %s\nnreplicas:%s",
                 counter, distance_to_center, n_replicas)
             raise OverflowError()
+        self._write_seed_manifest(next_iter_dir, seeds, modes)
+        checkpoint.seeded = True
+        self._save_checkpoint()
+
+    def _write_seed_manifest(self, next_iter_dir: str, seeds: Dict[str, int], modes: Dict[str, str]) -> None:
+        """
+        Writes seeds.json to the next iteration directory, mapping every in-{k}.gro to the walker it was seeded from
+        :param modes: how every in-{k}.gro was actually created, as returned by link_or_copy
+        """
+        manifest = {"iteration": self.iteration, "seed_mode": self.seed_mode, "seeds": seeds, "modes": modes}
+        tmp_file = "{}seeds.json.{}.tmp".format(next_iter_dir, os.getpid())
+        with open(tmp_file, "w") as out:
+            json.dump(manifest, out, indent=2)
+        os.replace(tmp_file, "{}seeds.json".format(next_iter_dir))
 
     def _compute_number_of_replicas(self, distance_to_center: np.array) -> np.array:
-        mean_dist = distance_to_center.mean()
+        weights = compute_weights(distance_to_center, self.exploration_type)
+        # Seeded per iteration so that a restarted iteration allocates the same replicas
+        rng = np.random.RandomState(None if self.seed is None else [self.seed, self.iteration])
+        return allocate_replicas(weights, self.swarm_size, method=self.replica_allocation, rng=rng)
 
-        def to_weight(d):
-            if "single" in self.exploration_type:
-                return np.exp(-(d / mean_dist) ** 2)
-            elif "multi" in self.exploration_type:
-                return expit((d / mean_dist) ** 2)
-            else:
-                raise ValueError("{} is not a valid exploration type".format(self.exploration_type))
-
-        weights = np.array([to_weight(d) for d in distance_to_center])
-        n_replicas = np.zeros(self.swarm_size, dtype=int)
-        replica = self.swarm_size
-        res = []
-        while replica > 0:
-            replica = int(replica)
-            weights[0:replica] /= weights[0:replica].sum()
-            for weight_order, idx in enumerate(reversed(np.argsort(weights))):
-                if weight_order >= replica:
-                    break
-                fractional_replicas = replica * weights[idx]
-                # for rounding,
-                # see https://stackoverflow.com/questions/28617841/rounding-to-nearest-int-with-numpy-rint-not-consistent-for-5
-                n_replicas[idx] += int(np.floor(fractional_replicas) + 0.5)
-                if n_replicas.sum() >= self.swarm_size:
-                    n_replicas[idx] -= n_replicas.sum() - self.swarm_size
-            replica = self.swarm_size - n_replicas.sum()
-            res.append(replica)
-
-        return n_replicas
-
-    def _load_evals(self) -> List[np.array]:
-        """
-
-        :return: The CV values for every walker trajectory
-        """
-        evals = []
-        for i in range(self.swarm_size):
-            t = load_traj_for_regex("./",
-                                    "s{}.xtc".format(i),
-                                    "s{}.gro".format(i),
-                                    stride=1,
-                                    query=self.query,
-                                    print_files=False)
-            ev = colvars.eval_cvs(cvs=self.cvs, traj=t)
-            evals.append(ev)
+    def _evaluate_finished_walkers(self, finished: Optional[List[int]] = None) -> None:
+        """
+        Starts evaluating the CVs in the background for every walker that has finished since the last call
+        :param finished: the finished walkers if already known
+        """
+        if finished is None:
+            finished = self.finished_walkers()
+        finished = [i for i in finished if i not in self._walker_evals and i not in self._walker_summaries]
+        if len(finished) == 0:
+            return
+        pool = self._evaluation_pool()
+        evaluate = evaluate_walker_with_metrics if self.collect_metrics else evaluate_walker
+        # The workers' working directory is not necessarily the iteration directory
+        directory = os.getcwd() + "/"
+        for i in finished:
+            _log.debug("Walker %s finished. Evaluating its CVs in the background", i)
+            self._walker_evals[i] = pool.submit(evaluate, i, self.cvs, self.query, directory, self._cvs_hash,
+                                                self.chunk_size, self.use_cache)
+
+    def _evaluation_pool(self) -> Executor:
+        if self.analysis_pool is not None:
+            return self.analysis_pool
+        if self._executor is None:
+            self._executor = create_process_pool(max(1, self.n_workers))
+        return self._executor
+
+    def collect_evaluations(self) -> None:
+        """
+        Summarizes the walkers whose background evaluation has completed and releases their CV values,
+        so that the frames of all walkers are never held in memory at once
+        """
+        for i in sorted(self._walker_evals):
+            future = self._walker_evals[i]
+            if future.done():
+                del self._walker_evals[i]
+                self._summarize_walker(i, self._evaluation_result(i, future.result(), in_background=True))
+
+    def _evaluation_result(self, walker_idx: int, result, in_background: bool) -> np.array:
+        """:return: the CV values of an evaluation, recording its metrics if collected"""
+        if not self.collect_metrics:
+            return result
+        evals, walker_metrics = result
+        self._metrics.record_walker(walker_idx, evaluated_in_background=in_background, **walker_metrics)
         return evals
+
+    def _summarize_walker(self, walker_idx: int, evals: np.array) -> None:
+        """Reduces the CV values of a walker to its WalkerSummary and appends them to the store"""
+        self._walker_summaries[walker_idx] = WalkerSummary.from_evals(evals)
+        if self.store is not None:
+            start = time.perf_counter()
+            self.store.append_walker(self.iteration, walker_idx, evals)
+            self._metrics.record_walker(walker_idx, store_seconds=time.perf_counter() - start)
+
+    def evaluations_pending(self) -> bool:
+        """True if some walker's CVs are still being evaluated in the background"""
+        return any(not f.done() for f in self._walker_evals.values())
+
+    def _shutdown_executor(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _iter_evals(self, walkers: List[int]) -> Iterator[Tuple[int, np.array]]:
+        """
+        Yields the CV values of the walkers not summarized yet.
+        Walkers not evaluated in the background are evaluated in the pool if n_workers > 1, otherwise in this process.
+        Evaluations in the pool are yielded in the order they complete, so that no result waits for slower walkers.
+        """
+        walkers = [i for i in walkers if i not in self._walker_summaries]
+        in_background = set(self._walker_evals)
+        if self.analysis_pool is not None or self.n_workers > 1:
+            self._evaluate_finished_walkers(walkers)
+        futures = {self._walker_evals[i]: i for i in walkers if i in self._walker_evals}
+        evaluate = evaluate_walker_with_metrics if self.collect_metrics else evaluate_walker
+        try:
+            for future in as_completed(futures):
+                i = futures[future]
+                del self._walker_evals[i]
+                yield i, self._evaluation_result(i, future.result(), in_background=i in in_background)
+            for i in walkers:
+                if i not in self._walker_summaries:
+                    result = evaluate(i, self.cvs, self.query, "./", self._cvs_hash, self.chunk_size, self.use_cache)
+                    yield i, self._evaluation_result(i, result, in_background=False)
+        finally:
+            self._shutdown_executor()
@@ -0,0 +1,122 @@
+import csv
+import json
+import os
+import resource
+import time
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any
+
+from . import log
+
+_log = log.getLogger(__name__)
+
+
+def peak_rss_bytes(children: Optional[bool] = False) -> int:
+    """
+    The peak resident set size of this process, or of its terminated child processes
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # kilobytes on Linux
+    return usage.ru_maxrss * 1024
+
+
+class _Span(object):
+    """Times a block of code and records it in Metrics when the block exits"""
+
+    def __init__(self, metrics: 'Metrics', name: str, attributes: Dict[str, Any]):
+        self._metrics = metrics
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+        self._start = None
+
+    def set(self, **attributes) -> None:
+        """Adds attributes to the recorded span, e.g. counters computed within the block"""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = self._metrics._stack
+        self.parent = stack[-1].name if len(stack) > 0 else None
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        seconds = time.perf_counter() - self._start
+        self._metrics._stack.pop()
+        record = {
+            "name": self.name,
+            "parent": self.parent,
+            "start": self._start - self._metrics._start,
+            "seconds": seconds,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        record.update(self.attributes)
+        self._metrics.spans.append(record)
+        return False
+
+
+class _DisabledSpan(object):
+    def set(self, **attributes) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_DISABLED_SPAN = _DisabledSpan()
+
+
+@dataclass
+class Metrics(object):
+    """
+    Durations of the stages of an iteration and per walker metrics.
+    When disabled, span() returns a shared no-op context manager and nothing is recorded.
+    """
+    enabled: Optional[bool] = True
+    spans: List[Dict[str, Any]] = field(default_factory=list)
+    walkers: Dict[int, Dict[str, Any]] = field(default_factory=dict)
+    _start: float = field(default_factory=time.perf_counter, init=False, repr=False)
+    _stack: List[_Span] = field(default_factory=list, init=False, repr=False)
+
+    def span(self, name: str, **attributes):
+        """
+        Usage:
+            with metrics.span("stage", walkers=4) as span:
+                ...
+                span.set(files=10)
+        """
+        if not self.enabled:
+            return _DISABLED_SPAN
+        return _Span(self, name, attributes)
+
+    def record_walker(self, walker_idx: int, **values) -> None:
+        if self.enabled:
+            self.walkers.setdefault(int(walker_idx), {}).update(values)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "spans": self.spans,
+            "walkers": {str(i): values for i, values in sorted(self.walkers.items())},
+            "peak_rss_bytes": peak_rss_bytes(),
+            "peak_rss_children_bytes": peak_rss_bytes(children=True),
+        }
+
+    def save(self, json_file: Optional[str] = "metrics.json", csv_file: Optional[str] = "walker_metrics.csv") -> None:
+        """Writes all metrics to json_file and the walker metrics, one row per walker, to csv_file"""
+        with open(json_file, "w") as out:
+            json.dump(self.to_dict(), out, indent=2)
+        columns = []
+        for values in self.walkers.values():
+            columns += [c for c in values if c not in columns]
+        with open(csv_file, "w", newline="") as out:
+            writer = csv.DictWriter(out, fieldnames=["walker"] + columns)
+            writer.writeheader()
+            for i, values in sorted(self.walkers.items()):
+                writer.writerow(dict(values, walker=i))
+        _log.debug("Saved metrics to %s and %s", os.path.abspath(json_file), os.path.abspath(csv_file))
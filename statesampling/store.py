@@ -0,0 +1,208 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any, Set, Tuple
+
+import numpy as np
+
+from . import log, colvars
+
+_log = log.getLogger(__name__)
+
+_EVALS_FILE = "evals.f8"
+_INDEX_FILE = "index.i4"
+_SEGMENTS_FILE = "segments.i8"
+_SEGMENT_BYTES = 8 * 4  # iteration, walker, first row, number of frames
+_ITERATIONS_FILE = "iterations.jsonl"
+_META_FILE = "meta.json"
+
+
+@dataclass
+class CvStore(object):
+    """
+    Append-only columnar store of the CV values of every frame of every walker in a run, plus per iteration results.
+
+    The store is a directory with the raw binary files
+     - evals.f8: float64 CV values, one row of n_cvs values per frame
+     - index.i4: int32 rows of (iteration, walker, frame) for every row in evals.f8
+     - segments.i8: int64 rows of (iteration, walker, first row, number of frames), one per stored walker
+    which can be memory-mapped with evals(), index() and segments(), and iterations.jsonl with one JSON object per line
+    containing the center, walkers, distance_to_center and/or n_replicas of an iteration.
+    Iteration -1 holds the center of the starting structure.
+
+    Only a writable store, see for_cvs, creates the directory and repairs appends interrupted by a crash when it is
+    opened. Other instances only read, e.g. while the server is still writing. They ignore rows past the last complete
+    segment.
+    """
+    directory: str
+    cv_ids: Optional[List[str]] = None
+    cvs_hash: Optional[str] = None
+    writable: Optional[bool] = False
+    _stored_walkers: Set[Tuple[int, int]] = field(default=None, init=False, repr=False)
+    _n_rows: int = field(default=0, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.writable:
+            os.makedirs(self.directory, exist_ok=True)
+        elif not os.path.isdir(self.directory):
+            raise FileNotFoundError("No CV store in {}".format(self.directory))
+        meta_file = self._path(_META_FILE)
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if self.cv_ids is not None and (meta["cv_ids"] != list(self.cv_ids) or meta["cvs_hash"] != self.cvs_hash):
+                raise ValueError("The CV store in {} was created with other CVs".format(self.directory))
+            self.cv_ids, self.cvs_hash = meta["cv_ids"], meta["cvs_hash"]
+        elif self.cv_ids is not None and self.writable:
+            self.cv_ids = list(self.cv_ids)
+            with open(meta_file, "w") as f:
+                json.dump({"cv_ids": self.cv_ids, "cvs_hash": self.cvs_hash}, f, indent=2)
+        if self.writable:
+            self._recover()
+        else:
+            self._stored_walkers = set((int(s[0]), int(s[1])) for s in self.segments())
+
+    @classmethod
+    def for_cvs(cls, directory: str, cvs) -> 'CvStore':
+        """Opens the store of a run for writing, creating it if needed"""
+        return cls(directory=directory, cv_ids=[cv.id for cv in cvs], cvs_hash=colvars.io.cvs_fingerprint(cvs),
+                   writable=True)
+
+    @property
+    def n_cvs(self) -> int:
+        return len(self.cv_ids)
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def _recover(self) -> None:
+        """Drops rows written after the last complete walker segment, e.g. if the process died while appending"""
+        path = self._path(_SEGMENTS_FILE)
+        if os.path.exists(path) and os.path.getsize(path) % _SEGMENT_BYTES != 0:
+            _log.warning("Truncating an incomplete segment in %s", path)
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) // _SEGMENT_BYTES * _SEGMENT_BYTES)
+        segments = self.segments()
+        self._stored_walkers = set((int(s[0]), int(s[1])) for s in segments)
+        self._n_rows = self._complete_rows(segments)
+        if self.cv_ids is None:
+            # Nothing has been written yet
+            return
+        for filename, row_bytes in [(_EVALS_FILE, 8 * self.n_cvs), (_INDEX_FILE, 4 * 3)]:
+            path = self._path(filename)
+            if os.path.exists(path) and os.path.getsize(path) > self._n_rows * row_bytes:
+                _log.warning("Truncating incomplete rows in %s", path)
+                with open(path, "r+b") as f:
+                    f.truncate(self._n_rows * row_bytes)
+
+    @staticmethod
+    def _complete_rows(segments: np.array) -> int:
+        return int(segments[-1, 2] + segments[-1, 3]) if len(segments) > 0 else 0
+
+    def _check_writable(self) -> None:
+        if not self.writable:
+            raise ValueError("The CV store in {} was opened read-only".format(self.directory))
+
+    def has_walker(self, iteration: int, walker: int) -> bool:
+        return (iteration, walker) in self._stored_walkers
+
+    def append_walker(self, iteration: int, walker: int, evals: np.array) -> None:
+        """Appends the CV values of all frames of a walker, unless the walker is already stored"""
+        self._check_writable()
+        if self.has_walker(iteration, walker):
+            return
+        evals = np.ascontiguousarray(evals, dtype=np.float64).reshape((-1, self.n_cvs))
+        n_frames = len(evals)
+        index = np.empty((n_frames, 3), dtype=np.int32)
+        index[:, 0] = iteration
+        index[:, 1] = walker
+        index[:, 2] = np.arange(n_frames)
+        with open(self._path(_EVALS_FILE), "ab") as f:
+            f.write(evals.tobytes())
+        with open(self._path(_INDEX_FILE), "ab") as f:
+            f.write(index.tobytes())
+        # The segment is written last. It marks the rows as complete
+        with open(self._path(_SEGMENTS_FILE), "ab") as f:
+            f.write(np.array([iteration, walker, self._n_rows, n_frames], dtype=np.int64).tobytes())
+        self._n_rows += n_frames
+        self._stored_walkers.add((iteration, walker))
+
+    def append_iteration(self, iteration: int, **values) -> None:
+        """
+        Records results for an iteration, e.g. center, walkers, distance_to_center or n_replicas.
+        Later records for the same iteration update earlier ones.
+        """
+        self._check_writable()
+        record = {"iteration": int(iteration)}
+        for k, v in values.items():
+            record[k] = np.asarray(v).tolist() if v is not None else None
+        with open(self._path(_ITERATIONS_FILE), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def _memmap(self, filename: str, dtype, n_columns: int, n_rows: int) -> np.array:
+        path = self._path(filename)
+        if n_rows == 0 or not os.path.exists(path):
+            return np.empty((0, n_columns), dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(n_rows, n_columns))
+
+    def segments(self) -> np.array:
+        """(iteration, walker, first row, number of frames) for every stored walker"""
+        path = self._path(_SEGMENTS_FILE)
+        n_segments = os.path.getsize(path) // _SEGMENT_BYTES if os.path.exists(path) else 0
+        return np.array(self._memmap(_SEGMENTS_FILE, np.int64, 4, n_segments))
+
+    def evals(self) -> np.array:
+        """Memory-mapped CV values of all stored frames, shape (n_frames, n_cvs)"""
+        return self._memmap(_EVALS_FILE, np.float64, self.n_cvs, self._rows())
+
+    def index(self) -> np.array:
+        """Memory-mapped (iteration, walker, frame) of all stored frames"""
+        return self._memmap(_INDEX_FILE, np.int32, 3, self._rows())
+
+    def _rows(self) -> int:
+        """The number of rows of complete walker segments. Another process may be appending to a read-only store"""
+        return self._n_rows if self.writable else self._complete_rows(self.segments())
+
+    def walker_evals(self, iteration: int, walker: int) -> Optional[np.array]:
+        for s in self.segments():
+            if s[0] == iteration and s[1] == walker:
+                return self.evals()[s[2]:s[2] + s[3]]
+        return None
+
+    def iteration_evals(self, iteration: int) -> np.array:
+        """The CV values of all frames of all walkers stored for the iteration"""
+        rows = [np.arange(s[2], s[2] + s[3]) for s in self.segments() if s[0] == iteration]
+        if len(rows) == 0:
+            return np.empty((0, self.n_cvs))
+        return self.evals()[np.concatenate(rows)]
+
+    def iterations(self) -> Dict[int, Dict[str, Any]]:
+        """The merged records of every iteration, see append_iteration"""
+        res = {}
+        path = self._path(_ITERATIONS_FILE)
+        if not os.path.exists(path):
+            return res
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    _log.warning("Skipping incomplete record in %s", path)
+                    continue
+                res.setdefault(record["iteration"], {}).update(record)
+        return res
+
+    def centers(self) -> List[np.array]:
+        """The centers of all iterations with a center, including the starting structure, in iteration order"""
+        iterations = self.iterations()
+        return [np.array(iterations[i]["center"]) for i in sorted(iterations)
+                if iterations[i].get("center") is not None]
+
+    def center_variances(self) -> List[Optional[np.array]]:
+        """The variance per CV of every center returned by centers(), or None if it was not recorded"""
+        iterations = self.iterations()
+        return [np.array(iterations[i]["center_variance"]) if iterations[i].get("center_variance") is not None else None
+                for i in sorted(iterations) if iterations[i].get("center") is not None]
@@ -0,0 +1,106 @@
+from dataclasses import dataclass
+from typing import Optional, List
+
+import numpy as np
+
+from . import log
+
+_log = log.getLogger(__name__)
+
+CENTER_WEIGHTINGS = ("frame", "walker")
+
+
+@dataclass
+class WalkerSummary(object):
+    """
+    Sufficient statistics of the CV values of a walker's frames: all that is needed to compute the center of an
+    iteration and the distance from the walker's endpoint to it.
+    """
+    n_frames: int
+    cv_sum: np.array  # sum of the CV values over all frames
+    endpoint: np.array  # CV values of the last frame
+    cv_sum_squares: Optional[np.array] = None  # sum of the squared CV values over all frames, if computed
+
+    @classmethod
+    def from_evals(cls, evals: np.array, with_squares: Optional[bool] = True) -> 'WalkerSummary':
+        """
+        :param evals: CV values with one row per frame
+        :param with_squares: also sum the squared values, needed for the spread of the frames around the center
+        """
+        evals = np.asarray(evals, dtype=np.float64)
+        if evals.ndim != 2 or len(evals) == 0:
+            raise ValueError("Cannot summarize CV values of shape {}".format(evals.shape))
+        return cls(n_frames=len(evals),
+                   cv_sum=evals.sum(axis=0),
+                   endpoint=evals[-1].copy(),
+                   cv_sum_squares=np.einsum('ij,ij->j', evals, evals) if with_squares else None)
+
+    @property
+    def mean(self) -> np.array:
+        return self.cv_sum / self.n_frames
+
+
+@dataclass
+class CenterEstimate(object):
+    """The center of the frames of an iteration and how precisely the walkers determine it"""
+    center: np.array
+    variance: Optional[np.array]  # of the center, per CV. None with fewer than two walkers
+    spread: Optional[np.array]  # variance of the frames around the center, per CV. None without sums of squares
+    n_walkers: int
+    n_frames: int
+
+    @property
+    def standard_error(self) -> Optional[float]:
+        """The standard error of the position of the center, comparable to the distance between two centers"""
+        if self.variance is None:
+            return None
+        return float(np.sqrt(self.variance.sum()))
+
+
+def walker_weights(summaries: List[WalkerSummary], weighting: Optional[str] = "frame") -> np.array:
+    """
+    :param weighting: 'frame' weighs every frame equally, so long walkers count more. 'walker' weighs every walker
+    equally, whatever its number of frames
+    :return: the weight of every walker in the center
+    """
+    if weighting == "frame":
+        return np.array([s.n_frames for s in summaries], dtype=np.float64)
+    elif weighting == "walker":
+        return np.ones((len(summaries),))
+    raise ValueError("{} is not a valid center weighting".format(weighting))
+
+
+def estimate_center(summaries: List[WalkerSummary], weighting: Optional[str] = "frame") -> CenterEstimate:
+    """
+    Merges the summaries of all walkers of an iteration.
+
+    Frames of the same walker are correlated, so the variance of the center is estimated from the spread of the walker
+    means around it (a ratio estimator over independent walkers) rather than from the number of frames.
+    """
+    if len(summaries) == 0:
+        raise ValueError("No walkers to compute the center from")
+    weights = walker_weights(summaries, weighting)
+    total_weight = weights.sum()
+    means = np.array([s.mean for s in summaries])
+    center = weights.dot(means) / total_weight
+    n_walkers = len(summaries)
+    variance = None
+    if n_walkers > 1:
+        variance = n_walkers / (n_walkers - 1) * (weights ** 2).dot((means - center) ** 2) / total_weight ** 2
+    spread = None
+    if all(s.cv_sum_squares is not None for s in summaries):
+        # Every frame of a walker gets an equal share of the walker's weight
+        frame_weights = weights / np.array([s.n_frames for s in summaries])
+        squares = frame_weights.dot(np.array([s.cv_sum_squares for s in summaries])) / total_weight
+        spread = np.maximum(squares - center ** 2, 0.)
+    return CenterEstimate(center=center,
+                          variance=variance,
+                          spread=spread,
+                          n_walkers=n_walkers,
+                          n_frames=int(sum(s.n_frames for s in summaries)))
+
+
+def distances_to_center(summaries: List[WalkerSummary], center: np.array) -> np.array:
+    """:return: the distance from the endpoint of every walker to the center"""
+    endpoints = np.array([s.endpoint for s in summaries])
+    return np.linalg.norm(endpoints - center, axis=1)
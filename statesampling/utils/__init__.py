@@ -1 +1 @@
-from . import io, trajs, visualization
\ No newline at end of file
+from . import io, slurm, topology, trajs, visualization
\ No newline at end of file
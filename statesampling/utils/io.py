@@ -2,6 +2,7 @@ import os
 import re
 import shutil
 import time
+from contextlib import contextmanager
 
 from .. import log
 
@@ -51,6 +52,41 @@ def makedirs(path, overwrite=False, backup=True):
         os.makedirs(path)
 
 
+def link_or_copy(src, dst, mode="copy"):
+    """
+    Creates dst with the contents of src, replacing dst if it exists.
+    :param mode: 'hardlink', 'symlink' (relative to the directory of dst) or 'copy'.
+    Links fall back to a copy if the filesystem does not support them.
+    :return: the mode actually used
+    """
+    if mode not in ("copy", "hardlink", "symlink"):
+        raise ValueError("{} is not a valid mode".format(mode))
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if mode == "hardlink":
+            os.link(src, dst)
+            return mode
+        elif mode == "symlink":
+            os.symlink(os.path.relpath(src, os.path.dirname(os.path.abspath(dst))), dst)
+            return mode
+    except OSError as ex:
+        _log.warning("Could not %s %s to %s (%s). Copying it instead", mode, src, dst, ex)
+    shutil.copy(src, dst)
+    return "copy"
+
+
+@contextmanager
+def working_directory(path):
+    """Changes the working directory to path within the block and back afterwards"""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
 def make_parentdirs(filepath):
     try:
         os.makedirs(os.path.dirname(filepath))
@@ -0,0 +1,57 @@
+import subprocess
+from typing import Optional, Iterable, Set
+
+from .. import log
+
+_log = log.getLogger("utils-slurm")
+
+
+def _format_indices(indices: Iterable[int]) -> str:
+    return ",".join(str(i) for i in sorted(indices))
+
+
+def submit_array(script: str, indices: Iterable[int]) -> Optional[str]:
+    """
+    Submits the script as a SLURM job array with the given array task indices
+
+    :return: the job id, or None if it could not be parsed from the output of sbatch
+    """
+    cmd = " ".join(["sbatch", "--parsable", "--array={}".format(_format_indices(indices)), script])
+    proc = subprocess.Popen(['/bin/bash', '-c', cmd], stdout=subprocess.PIPE, universal_newlines=True)
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+        _log.error("Command '%s' failed with exit code %s", cmd, proc.returncode)
+        return None
+    # The output is either 'jobid' or 'jobid;cluster'
+    job_id = out.strip().split(";")[0]
+    return job_id if len(job_id) > 0 else None
+
+
+def queued_array_tasks(job_id: str) -> Optional[Set[int]]:
+    """
+    :return: the array task indices of the job which are still pending or running,
+    or None if the queue could not be queried
+    """
+    proc = subprocess.Popen(['squeue', '--noheader', '--array', '--jobs={}'.format(job_id), '--format=%K'],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        if "Invalid job id" in err:
+            # The job has left the queue entirely
+            return set()
+        _log.warning("Could not query the queue for job %s: %s", job_id, err.strip())
+        return None
+    tasks = set()
+    for line in out.split():
+        if line.isdigit():
+            tasks.add(int(line))
+    return tasks
+
+
+def cancel_array_tasks(job_id: str, indices: Iterable[int]) -> None:
+    indices = list(indices)
+    if len(indices) == 0:
+        return
+    subprocess.call(['scancel', "{}_[{}]".format(job_id, _format_indices(indices))])
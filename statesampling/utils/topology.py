@@ -0,0 +1,108 @@
+import hashlib
+import os
+import weakref
+
+from .. import log
+
+_log = log.getLogger("utils-topology")
+
+# Topologies parsed from files, by fingerprint. Shared between all walkers with the same topology
+_topologies = {}
+# Fingerprints of topology objects in memory, by object id
+_fingerprints = {}
+# Selected atom indices by (fingerprint, query)
+_selections = {}
+# Index of every protein residue by resSeq, by fingerprint
+_residue_indices = {}
+
+
+def _gro_fingerprint(filename):
+    """
+    Fingerprint of the topology in a .gro file, computed from the residue numbers, residue names and atom names
+    without parsing the whole file into a topology
+    """
+    with open(filename, "rb") as f:
+        f.readline()  # title
+        n_atoms = int(f.readline())
+        h = hashlib.sha1()
+        for _ in range(n_atoms):
+            h.update(f.readline()[:15])
+    return "{}-{}".format(n_atoms, h.hexdigest())
+
+
+def _register(top, fp):
+    for k in [k for k, (ref, _) in _fingerprints.items() if ref() is None]:
+        del _fingerprints[k]
+    _fingerprints[id(top)] = (weakref.ref(top), fp)
+
+
+def fingerprint(top):
+    """
+    Identifies a topology by its number of atoms and a hash of the residue and atom names.
+    Cached per topology object as long as it is alive.
+    """
+    cached = _fingerprints.get(id(top))
+    if cached is not None and cached[0]() is top:
+        return cached[1]
+    h = hashlib.sha1()
+    for a in top.atoms:
+        h.update("{}{}{}".format(a.residue.resSeq, a.residue.name, a.name).encode("utf-8"))
+    fp = "{}-{}".format(top.n_atoms, h.hexdigest())
+    _register(top, fp)
+    return fp
+
+
+def load_topology(filename):
+    """
+    Loads the topology of a structure file.
+    Topologies of .gro files are parsed only once per fingerprint. The returned object is shared and should not be
+    modified other than by adding standard bonds.
+    """
+    import mdtraj as md
+    if os.path.splitext(filename)[1] != ".gro":
+        return md.load_topology(filename)
+    fp = _gro_fingerprint(filename)
+    top = _topologies.get(fp)
+    if top is None:
+        _log.debug("Parsing topology of %s", filename)
+        top = md.load_topology(filename)
+        _topologies[fp] = top
+    _register(top, fp)
+    return top
+
+
+def select(top, query):
+    """
+    Same as top.select(query) but cached per topology fingerprint and query.
+    :return: a read-only array of atom indices
+    """
+    key = (fingerprint(top), query)
+    atoms = _selections.get(key)
+    if atoms is None:
+        atoms = top.select(query)
+        atoms.setflags(write=False)
+        _selections[key] = atoms
+    return atoms
+
+
+def protein_residue_indices(top):
+    """
+    Maps the resSeq of every protein residue to its index in the topology.
+    Cached per topology fingerprint. The returned dict is shared and should not be modified.
+    """
+    fp = fingerprint(top)
+    residue_map = _residue_indices.get(fp)
+    if residue_map is None:
+        residue_map = {}
+        for residue in top.residues:
+            if residue.is_protein:
+                residue_map.setdefault(residue.resSeq, residue.index)
+        _residue_indices[fp] = residue_map
+    return residue_map
+
+
+def clear_cache():
+    _topologies.clear()
+    _fingerprints.clear()
+    _selections.clear()
+    _residue_indices.clear()
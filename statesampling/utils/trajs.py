@@ -1,8 +1,10 @@
 import glob
+import os
+import time
 
-import mdtraj as md
 import numpy as np
 
+from . import topology
 from .io import sorted_alphanumeric
 from .. import log
 
@@ -16,7 +18,8 @@ def fix_pbc(traj, check_if_necessary=True, atom_q="name CA and (resSeq 131 or re
     """
     if not check_if_necessary:
         return center_protein(traj)
-    atoms = traj.top.select(atom_q)
+    import mdtraj as md
+    atoms = topology.select(traj.top, atom_q)
     d_pbc = md.compute_distances(
         traj,
         [atoms],
@@ -47,9 +50,54 @@ def center_protein(traj, inplace=True):
     return traj.image_molecules(inplace=inplace, make_whole=True)
 
 
-def align_frames(traj, query="protein and name CA"):
-    atoms = traj.top.select(query)
-    return traj.superpose(traj, frame=0, atom_indices=atoms, ref_atom_indices=atoms, parallel=True)
+def align_frames(traj, query="protein and name CA", reference=None):
+    """Align all frames to the first frame of reference, or to the first frame of traj if no reference is given"""
+    atoms = topology.select(traj.top, query)
+    if reference is None:
+        reference = traj
+    return traj.superpose(reference, frame=0, atom_indices=atoms, ref_atom_indices=atoms, parallel=True)
+
+
+def select_cv_atoms(top, cvs, query=None, extra_queries=None):
+    """
+    The union of the atoms required to evaluate all CVs, as reported by CV.required_atoms
+
+    :param top: topology
+    :param cvs: the CVs that will be evaluated on the trajectory
+    :param query: if set, only atoms in this selection are considered
+    :param extra_queries: selections that should always be included, e.g. atoms used for preprocessing
+    :return: sorted atom indices, or None if any CV needs all atoms
+    """
+    atom_indices = []
+    for cv in cvs:
+        cv_atoms = cv.required_atoms(top)
+        if cv_atoms is None:
+            return None if query is None else topology.select(top, query)
+        atom_indices.append(np.asarray(cv_atoms, dtype=int))
+    for q in extra_queries or []:
+        atom_indices.append(topology.select(top, q))
+    atom_indices = np.unique(np.concatenate(atom_indices)) if len(atom_indices) > 0 else np.array([], dtype=int)
+    if query is not None:
+        atom_indices = np.intersect1d(atom_indices, topology.select(top, query))
+    return atom_indices
+
+
+def required_preprocessing(cvs):
+    """
+    :param cvs:
+    :return: tuple (fix_pbc, align), telling if any of the CVs requires whole molecules and aligned frames respectively
+    """
+    return any(cv.requires_whole_molecules for cv in cvs), any(cv.requires_alignment for cv in cvs)
+
+
+def _select_atoms_to_load(top, query, cvs, pbc_query, align_query):
+    if cvs is not None:
+        extra_queries = [q for q in [pbc_query, align_query] if q is not None]
+        return select_cv_atoms(top, cvs, query=query, extra_queries=extra_queries)
+    elif query is not None:
+        return topology.select(top, query)
+    else:
+        return None
 
 
 def load_traj_for_regex(directory,
@@ -59,24 +107,113 @@ def load_traj_for_regex(directory,
                         query=None,
                         center_and_align=True,
                         sort_function=sorted_alphanumeric,
-                        print_files=False):
-    toptraj = md.load(glob.glob(directory + top_filename)[0])
-    if query is not None:
-        atom_indices = toptraj.top.select(query)
-    else:
-        atom_indices = None
+                        print_files=False,
+                        cvs=None,
+                        pbc_query="name CA and (resSeq 131 or resSeq 268)",
+                        align_query="protein and name CA",
+                        stats=None):
+    """
+    :param center_and_align: fix periodic boundary conditions and align the frames.
+    If cvs are set, only the steps required by the CVs are performed
+    :param cvs: if set, only the atoms required to evaluate these CVs are loaded (within the query)
+    :param pbc_query: atoms used to check if the protein is broken by periodic boundary conditions
+    :param align_query: atoms used to align the frames
+    :param stats: if set, read_seconds, fix_pbc_seconds, align_seconds and bytes_read are added to this dict
+    """
+    import mdtraj as md
+    do_fix_pbc, do_align = center_and_align, center_and_align
+    if center_and_align and cvs is not None:
+        do_fix_pbc, do_align = required_preprocessing(cvs)
+    top_file = glob.glob(directory + top_filename)[0]
     if traj_filename is None:
+        toptraj = md.load(top_file)
+        atom_indices = _select_atoms_to_load(toptraj.top, query, cvs,
+                                             pbc_query if do_fix_pbc else None,
+                                             align_query if do_align else None)
         return toptraj if atom_indices is None else toptraj.atom_slice(atom_indices)
+    top = topology.load_topology(top_file)
+    atom_indices = _select_atoms_to_load(top, query, cvs,
+                                         pbc_query if do_fix_pbc else None,
+                                         align_query if do_align else None)
     file_list = sort_function(glob.glob(directory + traj_filename))
     _log.debug("Loading %s files from directory %s", len(file_list), directory)
     if print_files:
         _log.debug("Trajectories included:\n%s", "\n".join([t for t in file_list]))
+    start = time.perf_counter()
     traj = md.load(
         file_list,
-        top=toptraj.top,
+        top=top,
         atom_indices=atom_indices,
         stride=stride)
-    if center_and_align:
-        traj = fix_pbc(traj)
-        traj = align_frames(traj)
+    _record(stats, "read_seconds", time.perf_counter() - start)
+    if stats is not None:
+        _record(stats, "bytes_read", _files_size(file_list))
+    if do_fix_pbc:
+        start = time.perf_counter()
+        traj = fix_pbc(traj, atom_q=pbc_query)
+        _record(stats, "fix_pbc_seconds", time.perf_counter() - start)
+    if do_align:
+        start = time.perf_counter()
+        traj = align_frames(traj, query=align_query)
+        _record(stats, "align_seconds", time.perf_counter() - start)
     return traj
+
+
+def iterload_traj_for_regex(directory,
+                            traj_filename,
+                            top_filename,
+                            chunk=1000,
+                            stride=1,
+                            query=None,
+                            center_and_align=True,
+                            sort_function=sorted_alphanumeric,
+                            cvs=None,
+                            pbc_query="name CA and (resSeq 131 or resSeq 268)",
+                            align_query="protein and name CA",
+                            stats=None):
+    """
+    Same as load_traj_for_regex but yields the trajectory in chunks of at most 'chunk' frames,
+    so that memory usage is bounded by the chunk size rather than the trajectory length.
+    All chunks are aligned to the first frame of the first chunk.
+    """
+    import mdtraj as md
+    do_fix_pbc, do_align = center_and_align, center_and_align
+    if center_and_align and cvs is not None:
+        do_fix_pbc, do_align = required_preprocessing(cvs)
+    top = topology.load_topology(glob.glob(directory + top_filename)[0])
+    atom_indices = _select_atoms_to_load(top, query, cvs,
+                                         pbc_query if do_fix_pbc else None,
+                                         align_query if do_align else None)
+    file_list = sort_function(glob.glob(directory + traj_filename))
+    _log.debug("Streaming %s files from directory %s in chunks of %s frames", len(file_list), directory, chunk)
+    reference = None
+    if stats is not None:
+        _record(stats, "bytes_read", _files_size(file_list))
+    for f in file_list:
+        chunks = md.iterload(f, chunk=chunk, top=top, atom_indices=atom_indices, stride=stride)
+        while True:
+            start = time.perf_counter()
+            traj = next(chunks, None)
+            _record(stats, "read_seconds", time.perf_counter() - start)
+            if traj is None:
+                break
+            if do_fix_pbc:
+                start = time.perf_counter()
+                traj = fix_pbc(traj, atom_q=pbc_query)
+                _record(stats, "fix_pbc_seconds", time.perf_counter() - start)
+            if do_align:
+                start = time.perf_counter()
+                if reference is None:
+                    reference = traj[0]
+                traj = align_frames(traj, query=align_query, reference=reference)
+                _record(stats, "align_seconds", time.perf_counter() - start)
+            yield traj
+
+
+def _record(stats, key, value):
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + value
+
+
+def _files_size(files):
+    return sum(os.path.getsize(f) for f in files)
@@ -1,16 +1,37 @@
+import sys
 from typing import Optional, List
 
-import matplotlib.pyplot as plt
 import numpy as np
 
-plt.style.use("seaborn-colorblind")
-
 from .. import log
 
 _log = log.getLogger("utils-viz")
 
 
-def show_convergence(center_points: List, outfile: Optional[str] = None) -> None:
+def _pyplot(headless: bool):
+    """
+    Imports pyplot on first use, since importing matplotlib is slow.
+    :param headless: use a non-interactive backend unless pyplot has already been imported
+    """
+    import matplotlib
+    if headless and "matplotlib.pyplot" not in sys.modules:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    plt.style.use("seaborn-colorblind")
+    return plt
+
+
+def show_convergence(center_points: List, outfile: Optional[str] = None, xlabel: Optional[str] = "Iteration",
+                     center_variances: Optional[List] = None) -> None:
+    """
+    Plots the distance between consecutive center points
+    :param center_points: centers of every iteration, or of every window of endpoints in asynchronous mode
+    :param outfile:
+    :param xlabel:
+    :param center_variances: the variance per CV of every center, or None where unknown.
+    If set, the standard error of the distances is plotted too
+    """
+    plt = _pyplot(headless=outfile is not None)
     npoints = len(center_points)
     convergence = np.empty((npoints - 1))
     previous_point = None
@@ -23,12 +44,32 @@ def show_convergence(center_points: List, outfile: Optional[str] = None) -> None
             xticks.append("$|\\bar{c}_{%s}-\\bar{c}_{in}|$" % (idx))
         previous_point = cp
     xvals = np.linspace(1, npoints - 1, npoints - 1)
+    # A new figure per plot, so that the plots of many runs in one process are not drawn on top of each other
+    plt.figure()
     plt.plot(xvals, convergence)
-    plt.xlabel("Iteration")
-    plt.xticks(xvals, xticks)
+    if center_variances is not None:
+        # Distances below this line cannot be told apart from statistical noise
+        noise = np.full((npoints - 1,), np.nan)
+        for idx in range(1, npoints):
+            variance, previous_variance = center_variances[idx], center_variances[idx - 1]
+            if variance is not None and previous_variance is not None:
+                noise[idx - 1] = np.sqrt(np.sum(variance) + np.sum(previous_variance))
+        plt.plot(xvals, noise, '--', label="Standard error")
+        plt.legend()
+    plt.xlabel(xlabel)
+    # One label per distance. The label of the last center has no distance to show
+    plt.xticks(xvals, xticks[:len(xvals)])
     plt.ylabel("Distance between iteration centers")
     plt.tight_layout(pad=0.3)
     if outfile is None:
         plt.show()
     else:
         plt.savefig(outfile)
+        plt.close()
+
+
+def show_store_convergence(store_directory: str, outfile: Optional[str] = None) -> None:
+    """Plots the convergence of the centers recorded in a CV store, see statesampling.store.CvStore"""
+    from ..store import CvStore
+    store = CvStore(store_directory)
+    show_convergence(store.centers(), outfile=outfile, center_variances=store.center_variances())
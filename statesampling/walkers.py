@@ -0,0 +1,120 @@
+import os
+import time
+from typing import Optional, List, Dict, Any, Tuple
+
+import numpy as np
+
+from . import log, colvars, metrics
+from .utils.trajs import load_traj_for_regex, iterload_traj_for_regex
+
+_log = log.getLogger(__name__)
+
+
+def evaluate_walker(walker_idx: int,
+                    cvs: List[colvars.CV],
+                    query: Optional[str] = "protein",
+                    directory: Optional[str] = "./",
+                    cvs_hash: Optional[str] = None,
+                    chunk_size: Optional[int] = None,
+                    use_cache: Optional[bool] = True) -> np.array:
+    """
+    Loads the trajectory of a single walker and evaluates the CVs on every frame.
+    CV values precomputed by the walker itself are used if they are up to date.
+
+    :param walker_idx: index of the walker, i.e. the trajectory s{walker_idx}.xtc with topology s{walker_idx}.gro
+    :param cvs:
+    :param query: atom selection used when loading the trajectory
+    :param directory: directory containing the walker files
+    :param cvs_hash: fingerprint of the CVs as returned by colvars.io.cvs_fingerprint. Computed if not set
+    :param chunk_size: if set, the trajectory is streamed from disk in chunks of this many frames
+    instead of being loaded into memory all at once
+    :param use_cache: read and write the CV values from an on-disk cache next to the trajectory
+    :return: the CV values as an array of shape (n_frames, n_cvs)
+    """
+    return _evaluate_walker(walker_idx, cvs, query, directory, cvs_hash, chunk_size, use_cache)
+
+
+def evaluate_walker_with_metrics(walker_idx: int,
+                                 cvs: List[colvars.CV],
+                                 query: Optional[str] = "protein",
+                                 directory: Optional[str] = "./",
+                                 cvs_hash: Optional[str] = None,
+                                 chunk_size: Optional[int] = None,
+                                 use_cache: Optional[bool] = True) -> Tuple[np.array, Dict[str, Any]]:
+    """
+    Same as evaluate_walker but also returns metrics: where the CV values came from ('precomputed', 'cache' or
+    'trajectory'), the time spent reading, fixing periodic boundary conditions, aligning and evaluating,
+    the number of frames, the bytes read and the peak RSS of the evaluating process
+    """
+    stats = {}
+    start = time.perf_counter()
+    evals = _evaluate_walker(walker_idx, cvs, query, directory, cvs_hash, chunk_size, use_cache, stats=stats)
+    stats.update(seconds=time.perf_counter() - start, frames=len(evals), peak_rss_bytes=metrics.peak_rss_bytes())
+    return evals, stats
+
+
+def _evaluate_walker(walker_idx, cvs, query, directory, cvs_hash, chunk_size, use_cache, stats=None):
+    traj_filename = "s{}.xtc".format(walker_idx)
+    top_filename = "s{}.gro".format(walker_idx)
+    if cvs_hash is None:
+        cvs_hash = colvars.io.cvs_fingerprint(cvs)
+    cache_key = None
+    if cvs_hash is not None:
+        cache_key = walker_cache_key(walker_idx, cvs_hash, query=query, directory=directory)
+        evals = colvars.cache.load_precomputed_evals(directory + traj_filename, cache_key)
+        if evals is not None:
+            if stats is not None:
+                stats.update(source="precomputed", bytes_read=evals.nbytes)
+            return evals
+        if use_cache:
+            cache_file = colvars.cache.cache_path(directory + traj_filename)
+            evals = colvars.cache.load_cached_evals(cache_file, cache_key)
+            if evals is not None:
+                if stats is not None:
+                    stats.update(source="cache", bytes_read=os.path.getsize(cache_file))
+                return evals
+    if stats is not None:
+        stats.update(source="trajectory", eval_seconds=0.)
+    if chunk_size is None:
+        t = load_traj_for_regex(directory,
+                                traj_filename,
+                                top_filename,
+                                stride=1,
+                                query=query,
+                                print_files=False,
+                                cvs=cvs,
+                                stats=stats)
+        start = time.perf_counter()
+        evals = colvars.eval_cvs(cvs=cvs, traj=t)
+        if stats is not None:
+            stats["eval_seconds"] += time.perf_counter() - start
+    else:
+        evals = []
+        for t in iterload_traj_for_regex(directory,
+                                         traj_filename,
+                                         top_filename,
+                                         chunk=chunk_size,
+                                         stride=1,
+                                         query=query,
+                                         cvs=cvs,
+                                         stats=stats):
+            start = time.perf_counter()
+            evals.append(colvars.eval_cvs(cvs=cvs, traj=t))
+            if stats is not None:
+                stats["eval_seconds"] += time.perf_counter() - start
+        evals = np.concatenate(evals, axis=0) if len(evals) > 0 else np.empty((0, len(cvs)))
+    if cache_key is not None and use_cache:
+        colvars.cache.save_cached_evals(colvars.cache.cache_path(directory + traj_filename), cache_key, evals)
+    return evals
+
+
+def walker_cache_key(walker_idx: int,
+                     cvs_hash: str,
+                     query: Optional[str] = "protein",
+                     directory: Optional[str] = "./") -> str:
+    """The key identifying CV values evaluated on the current trajectory and topology files of the walker"""
+    return colvars.cache.create_cache_key([directory + "s{}.xtc".format(walker_idx),
+                                           directory + "s{}.gro".format(walker_idx)],
+                                          cvs_hash,
+                                          query=query)
+